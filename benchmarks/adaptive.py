@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Compares fixed batching with the AdaptiveController against the stub
+server at several simulated latencies.
+
+    python benchmarks/adaptive.py --latencies 0,0.05,0.2 --events 2500
+"""
+
+import os
+import sys
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from segmentio.adaptive import AdaptiveController
+
+from load import add_options, report, run
+
+
+def main():
+    parser = OptionParser()
+    add_options(parser)
+    parser.add_option('--latencies', default='0,0.05,0.2',
+                      help='comma separated stub latencies in seconds')
+    parser.add_option('--target-latency', type='float', default=0.5)
+    opts, args = parser.parse_args()
+
+    for latency in [float(l) for l in opts.latencies.split(',')]:
+        opts.latency = latency
+
+        for mode in ['fixed', 'adaptive']:
+            kwargs = {}
+            if mode == 'adaptive':
+                kwargs['adaptive'] = AdaptiveController(
+                    max_batch=1000, batch_step=25,
+                    target_latency=opts.target_latency)
+
+            results = run(opts, **kwargs)
+            results.update(mode=mode, latency=latency)
+
+            if opts.json:
+                report(results, True)
+            else:
+                print ('latency %.3fs %-8s %8.0f delivered ev/s %5d requests '
+                       'p99 delivery %7.0fms batch %d' % (
+                           latency, mode, results['delivered_events_per_sec'],
+                           results['requests'], results['delivery_p99_ms'],
+                           results['max_flush_size']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Measures what hoisting shared contexts to the batch saves in bytes on
+the wire and encode time, sending the same traffic to the local stub server
+with and without it, and checks the events decode to the same thing.
+
+    python benchmarks/context.py [--events 20000 --users 200]
+"""
+
+import os
+import random
+import sys
+from datetime import datetime
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from dateutil.tz import tzutc
+
+from segmentio import options
+from segmentio.client import Client
+from segmentio.profiling import AggregateSink, Profiler
+from segmentio.stats import Statistics
+from segmentio.utils import merge_context
+
+from stub_server import StubServer
+
+APP = {'name': 'Jukebox', 'version': '2.4.1', 'build': '4410'}
+TIMESTAMP = datetime(2013, 6, 1, tzinfo=tzutc())
+
+
+def traffic(events, users, seed=1):
+    """Yields (user_id, context) pairs of a server handling requests, each
+    request tracking a few events with the same context
+
+    """
+    rand = random.Random(seed)
+    agents = ['Mozilla/5.0 (Macintosh; Intel Mac OS X 10_8_4) Safari/536.30',
+              'Mozilla/5.0 (Windows NT 6.1; WOW64) Chrome/27.0.1453.116',
+              'Mozilla/5.0 (iPhone; CPU iPhone OS 6_1_4) Mobile/10B350']
+
+    sent = 0
+    while sent < events:
+        user = rand.randint(0, users - 1)
+        context = {'app': APP, 'locale': 'en-US', 'os': 'Linux',
+                   'ip': '10.0.%d.%d' % (user // 256, user % 256),
+                   'userAgent': agents[user % len(agents)]}
+        for i in range(rand.randint(1, 4)):
+            yield 'user%d@example.com' % user, dict(context)
+            sent += 1
+
+
+def measure(opts, hoist):
+    stub = StubServer(keep_batches=True).start()
+    previous_host = options.host
+    options.host = stub.url
+
+    aggregate = AggregateSink()
+    client = Client('testsecret', log=False, stats=Statistics(),
+                    async=False, flush_at=opts.flush_at,
+                    max_queue_size=opts.events * 2,
+                    profiler=Profiler([aggregate]), hoist_context=hoist)
+    client.max_flush_size = opts.flush_at
+
+    try:
+        for i, (user_id, context) in enumerate(
+                traffic(opts.events, opts.users)):
+            client.track(user_id, 'Played a Song',
+                         {'Song': 'Eleanor Rigby', 'Plays': i},
+                         context=context, timestamp=TIMESTAMP)
+            if i + 1 == opts.events:
+                break
+        client.flush(async=False)
+    finally:
+        client.transport.close()
+        options.host = previous_host
+        stub.stop()
+
+    encode = aggregate.snapshot()['encode']
+    events = [action for batch in stub.received
+              for action in merge_context(batch)]
+    return stub.bytes, encode['total'], encode['count'], events
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--events', type='int', default=20000)
+    parser.add_option('--users', type='int', default=200)
+    parser.add_option('--flush-at', type='int', default=50)
+    opts, args = parser.parse_args()
+
+    plain_bytes, plain_encode, batches, plain = measure(opts, False)
+    hoisted_bytes, hoisted_encode, batches, hoisted = measure(opts, True)
+
+    print '%-8s %10s %14s' % ('', 'bytes', 'encode us/batch')
+    print '%-8s %10d %14.1f' % ('plain', plain_bytes,
+                                plain_encode / batches * 1e6)
+    print '%-8s %10d %14.1f' % ('hoisted', hoisted_bytes,
+                                hoisted_encode / batches * 1e6)
+    print '%-8s %+9.1f%% %+13.1f%%' % (
+        'change', (float(hoisted_bytes) / plain_bytes - 1) * 100,
+        (hoisted_encode / plain_encode - 1) * 100)
+
+    print
+    print 'decoded events equivalent: %s (%d events)' % (
+        plain == hoisted, len(plain))
+    if plain != hoisted:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Compares what track() costs callers with large nested properties when
+cleaning happens on the calling thread and when it is deferred to the flush
+thread.
+
+    python benchmarks/deferred.py [--threads 4 --events 2000 --width 50]
+"""
+
+import os
+import sys
+import threading
+from datetime import datetime
+from optparse import OptionParser
+from time import sleep, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from segmentio.client import Client
+from segmentio.stats import Statistics
+from segmentio.transport import MemoryTransport
+
+from load import percentile
+
+
+def make_properties(width, depth):
+    """ A dict of width keys, nesting width dicts depth levels deep """
+    properties = {}
+    for i in range(width):
+        key = 'key%d' % i
+        if depth > 1 and i % 10 == 0:
+            properties[key] = make_properties(width, depth - 1)
+        elif i % 3 == 0:
+            properties[key] = datetime(2013, 1, 1)
+        elif i % 3 == 1:
+            properties[key] = ['value%d' % i, i, i * 1.5]
+        else:
+            properties[key] = 'value%d' % i
+    return properties
+
+
+def produce(client, count, properties, latencies):
+    for i in range(count):
+        start = time()
+        client.track('user%d@example.com' % i, 'Played a Song', properties)
+        latencies.append(time() - start)
+
+
+def measure(opts, defer_cleaning):
+    stats = Statistics()
+    client = Client('testsecret', log=False, stats=stats,
+                    flush_at=opts.flush_at, max_queue_size=10 ** 6,
+                    transport=MemoryTransport(max_size=1),
+                    defer_cleaning=defer_cleaning)
+
+    properties = make_properties(opts.width, opts.depth)
+    latencies = [[] for i in range(opts.threads)]
+    threads = [threading.Thread(target=produce,
+                                args=(client, opts.events, properties,
+                                      latencies[i]))
+               for i in range(opts.threads)]
+
+    start = time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    deadline = time() + opts.drain_timeout
+    while stats.successful + stats.failed < stats.submitted and \
+            time() < deadline:
+        client.flush()
+        sleep(0.01)
+    drained = time() - start
+
+    caller = [latency for thread in latencies for latency in thread]
+    return (percentile(caller, 0.5), percentile(caller, 0.99),
+            stats.successful / drained)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--threads', type='int', default=4)
+    parser.add_option('--events', type='int', default=2000,
+                      help='events sent by each thread')
+    parser.add_option('--width', type='int', default=50,
+                      help='keys per properties dict')
+    parser.add_option('--depth', type='int', default=3,
+                      help='levels of nested dicts')
+    parser.add_option('--flush-at', type='int', default=100)
+    parser.add_option('--drain-timeout', type='float', default=60)
+    opts, args = parser.parse_args()
+
+    for name, defer_cleaning in (('caller', False), ('deferred', True)):
+        p50, p99, throughput = measure(opts, defer_cleaning)
+        print '%-9s p50 %8.1f us  p99 %8.1f us  %8.0f delivered/s' % (
+            name, p50 * 1e6, p99 * 1e6, throughput)
+
+
+if __name__ == '__main__':
+    main()
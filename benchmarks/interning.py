@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Measures what interning event names and property keys saves in memory
+held by the queue and in encode time, against what it adds to each track()
+call. Properties are decoded from JSON for each event, the way a server
+relaying its own requests would get them, so equal keys start out as
+different objects.
+
+    python benchmarks/interning.py [--events 20000 --keys 20]
+"""
+
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+from optparse import OptionParser
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from segmentio.client import Client
+from segmentio.stats import Statistics
+
+
+def make_events(count, keys):
+    """ Event names and properties decoded from a JSON body per event """
+    body = json.dumps({
+        'event': 'Played a Song',
+        'properties': dict(('Property %d' % i, i) for i in range(keys))
+    })
+    return [json.loads(body) for i in range(count)]
+
+
+def string_bytes(actions):
+    """ The bytes of the distinct event and key string objects queued """
+    seen = {}
+    for action in actions:
+        for s in [action['event']] + action['properties'].keys():
+            seen[id(s)] = sys.getsizeof(s)
+    return sum(seen.itervalues())
+
+
+def measure(opts, intern_strings):
+    client = Client('testsecret', log=False, stats=Statistics(),
+                    flush_at=opts.events * 2, flush_after=timedelta(days=1),
+                    max_queue_size=opts.events * 2,
+                    intern_strings=intern_strings)
+    client.last_flushed = datetime.now()
+
+    events = make_events(opts.events, opts.keys)
+
+    start = time()
+    for event in events:
+        client.track('ilya@analytics.io', event['event'],
+                     event['properties'])
+    caller = (time() - start) / opts.events
+
+    actions = list(client.queue)
+    memory = string_bytes(actions)
+
+    batches = [actions[i:i + opts.batch_size]
+               for i in range(0, len(actions), opts.batch_size)]
+    start = time()
+    for batch in batches:
+        client.serializer.dumps({'batch': batch, 'secret': client.secret})
+    encode = (time() - start) / len(batches)
+
+    return caller, memory, encode
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--events', type='int', default=20000)
+    parser.add_option('--keys', type='int', default=20,
+                      help='keys per properties dict')
+    parser.add_option('--batch-size', type='int', default=50)
+    opts, args = parser.parse_args()
+
+    print '%-10s %12s %14s %16s' % ('', 'track us', 'string bytes',
+                                    'encode us/batch')
+    results = []
+    for name, intern_strings in (('plain', False), ('interned', True)):
+        caller, memory, encode = measure(opts, intern_strings)
+        results.append((caller, memory, encode))
+        print '%-10s %12.1f %14d %16.1f' % (name, caller * 1e6, memory,
+                                            encode * 1e6)
+
+    (plain_caller, plain_memory, plain_encode), \
+        (caller, memory, encode) = results
+    print '%-10s %+11.1f%% %+13.1f%% %+15.1f%%' % (
+        'change', (caller / plain_caller - 1) * 100,
+        (float(memory) / plain_memory - 1) * 100,
+        (encode / plain_encode - 1) * 100)
+
+
+if __name__ == '__main__':
+    main()
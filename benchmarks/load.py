@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Drives a Client with synthetic traffic from many threads against the
+local stub server, and reports throughput, latency and memory.
+
+    python benchmarks/load.py --threads 8 --events 5000 --latency 0.02
+    python benchmarks/load.py --transport file --json >> bench_output.txt
+"""
+
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+from optparse import OptionParser
+from time import sleep, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from segmentio import options
+from segmentio.client import Client
+from segmentio.stats import Statistics
+from segmentio.transport import FileTransport, MemoryTransport
+from segmentio.utils import total_seconds
+
+from stub_server import StubServer
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def rss_kb():
+    """ The peak resident set size of this process """
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on OS X, kilobytes elsewhere
+    if sys.platform == 'darwin':
+        usage /= 1024
+    return usage
+
+
+def make_properties(i):
+    return {
+        'Artist': 'The Beatles',
+        'Song': 'Eleanor Rigby',
+        'Plays': i,
+        'Tags': ['rock', 'pop'],
+        'sentAt': time()
+    }
+
+
+def produce(client, count, latencies):
+    for i in range(count):
+        start = time()
+        client.track('user%d@example.com' % (i % 1000), 'Played a Song',
+                     make_properties(i))
+        latencies.append(time() - start)
+
+
+def add_options(parser):
+    """ Options shared by the benchmarks that drive a client """
+    parser.add_option('--threads', type='int', default=4)
+    parser.add_option('--events', type='int', default=2500,
+                      help='events sent by each thread')
+    parser.add_option('--flush-at', type='int', default=20)
+    parser.add_option('--max-queue-size', type='int', default=100000)
+    parser.add_option('--latency', type='float', default=0,
+                      help='stub server response latency in seconds')
+    parser.add_option('--error-rate', type='float', default=0)
+    parser.add_option('--throttle-rate', type='float', default=0)
+    parser.add_option('--slow-read', type='float', default=0)
+    parser.add_option('--transport', default='http',
+                      help='http (to the stub server), file or memory')
+    parser.add_option('--drain-timeout', type='float', default=60)
+    parser.add_option('--json', action='store_true', default=False,
+                      help='print a single JSON line for trend tracking')
+
+
+def run(opts, **client_kwargs):
+    """Runs one load test and returns its results as a dict. Extra keyword
+    arguments are passed to the Client.
+
+    """
+    stub = StubServer(latency=opts.latency, error_rate=opts.error_rate,
+                      throttle_rate=opts.throttle_rate,
+                      slow_read=opts.slow_read).start()
+    previous_host = options.host
+    options.host = stub.url
+
+    directory = None
+    if opts.transport == 'file':
+        directory = tempfile.mkdtemp()
+        client_kwargs['transport'] = FileTransport(
+            os.path.join(directory, 'events.jsonl'))
+    elif opts.transport == 'memory':
+        client_kwargs['transport'] = MemoryTransport(max_size=1000)
+
+    stats = Statistics()
+    client = Client('testsecret', log=False, stats=stats,
+                    flush_at=opts.flush_at,
+                    max_queue_size=opts.max_queue_size, **client_kwargs)
+
+    total = opts.threads * opts.events
+    latencies = [[] for i in range(opts.threads)]
+    threads = [threading.Thread(target=produce,
+                                args=(client, opts.events, latencies[i]))
+               for i in range(opts.threads)]
+
+    try:
+        start = time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        produced = time() - start
+
+        # drain what's left, giving up once nothing is left to wait for
+        deadline = time() + opts.drain_timeout
+        while stats.successful + stats.failed < stats.submitted and \
+                time() < deadline:
+            client.flush()
+            sleep(0.05)
+        drained = time() - start
+
+    finally:
+        client.transport.close()
+        options.host = previous_host
+        stub.stop()
+        if directory is not None:
+            shutil.rmtree(directory)
+
+    caller = [latency for thread in latencies for latency in thread]
+
+    return {
+        'transport': opts.transport,
+        'threads': opts.threads,
+        'events': total,
+        'submitted': stats.submitted,
+        'dropped': stats.dropped,
+        'successful': stats.successful,
+        'failed': stats.failed,
+        'received': stub.events,
+        'requests': sum(stub.responses.values()),
+        'responses': dict((str(code), count)
+                          for code, count in stub.responses.items()),
+        'produce_events_per_sec': total / produced,
+        'delivered_events_per_sec': stats.successful / drained,
+        'caller_p50_ms': percentile(caller, 0.5) * 1000,
+        'caller_p99_ms': percentile(caller, 0.99) * 1000,
+        'delivery_p50_ms': (percentile(stub.delivery_latencies, 0.5) or 0)
+        * 1000,
+        'delivery_p99_ms': (percentile(stub.delivery_latencies, 0.99) or 0)
+        * 1000,
+        'max_flush_size': client.max_flush_size,
+        'flush_after_sec': total_seconds(client.flush_after),
+        'max_rss_kb': rss_kb()
+    }
+
+
+def report(results, as_json=False):
+    if as_json:
+        results = dict(results, time=time())
+        print json.dumps(results, sort_keys=True)
+        return
+
+    for key in sorted(results):
+        value = results[key]
+        if isinstance(value, float):
+            value = '%.3f' % value
+        print '%-26s %s' % (key, value)
+
+
+def main():
+    parser = OptionParser()
+    add_options(parser)
+    opts, args = parser.parse_args()
+
+    report(run(opts), opts.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Measures what profiling costs track() callers: disabled, aggregating
+every stage, and tracing every event.
+
+    python benchmarks/profiling.py [--events 50000]
+"""
+
+import os
+import sys
+from optparse import OptionParser
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from segmentio.client import Client
+from segmentio.profiling import AggregateSink, Profiler
+from segmentio.stats import Statistics
+from segmentio.transport import MemoryTransport
+
+
+def measure(events, profiler):
+    client = Client('testsecret', log=False, stats=Statistics(),
+                    async=False, flush_at=1000, max_queue_size=events * 2,
+                    transport=MemoryTransport(max_size=1), profiler=profiler)
+
+    properties = {'Artist': 'The Beatles', 'Song': 'Eleanor Rigby',
+                  'Plays': 1, 'Tags': ['rock', 'pop']}
+
+    start = time()
+    for i in range(events):
+        client.track('ilya@analytics.io', 'Played a Song', properties)
+    return (time() - start) / events
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--events', type='int', default=50000)
+    opts, args = parser.parse_args()
+
+    aggregate = AggregateSink()
+    modes = [('disabled', None),
+             ('aggregate', Profiler([aggregate])),
+             ('trace 1%', Profiler([AggregateSink()], trace_rate=0.01)),
+             ('trace all', Profiler([AggregateSink()], trace_rate=1.0))]
+
+    baseline = None
+    for name, profiler in modes:
+        per_call = measure(opts.events, profiler)
+        if baseline is None:
+            baseline = per_call
+        print '%-10s %7.2f us/track %+6.1f%%' % (
+            name, per_call * 1e6, (per_call / baseline - 1) * 100)
+
+    print
+    for stage, timing in sorted(aggregate.snapshot().items()):
+        print '%-10s %7.2f us mean over %d' % (stage, timing['mean'] * 1e6,
+                                               timing['count'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Compares the installed JSON serializers on realistic batches.
+
+    python benchmarks/serialization.py [--batches 2000] [--size 50]
+"""
+
+import json
+import os
+import sys
+from datetime import datetime
+from decimal import Decimal
+from optparse import OptionParser
+from random import randint, random
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from segmentio.client import Client
+from segmentio.utils import serializers, DatetimeSerializer
+
+
+def make_batch(client, size):
+    """ Builds a batch shaped like the ones _sync_flush sends """
+    batch = []
+    for i in range(size):
+        properties = client._clean({
+            'Artist': 'The Beatles',
+            'Song': 'Eleanor Rigby',
+            'Album': u'Revolver – Remastered',
+            'Price': Decimal('1.29'),
+            'Plays': randint(0, 100000),
+            'Rating': random(),
+            'Released': datetime(1966, 8, 5, 10, 30),
+            'Tags': ['rock', 'pop', '1960s'],
+            'Listened At': datetime.now()
+        })
+        batch.append({
+            'userId': 'user%d@example.com' % randint(0, 1000),
+            'event': 'Played a Song',
+            'properties': properties,
+            'context': {'library': 'analytics-python',
+                        'ip': '12.31.42.111',
+                        'userAgent': 'Mozilla/5.0 (Macintosh)'},
+            'timestamp': datetime.now().isoformat(),
+            'action': 'track'
+        })
+    return {'batch': batch, 'secret': 'testsecret'}
+
+
+def measure(dumps, payloads):
+    start = time()
+    size = 0
+    for payload in payloads:
+        size += len(dumps(payload))
+    return time() - start, size
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--batches', type='int', default=2000)
+    parser.add_option('--size', type='int', default=50)
+    options, args = parser.parse_args()
+
+    client = Client('testsecret', send=False)
+    payloads = [make_batch(client, options.size)
+                for i in range(options.batches)]
+
+    # the previous encoding path, datetimes left to the default() hook
+    raw = [make_batch(Client('testsecret', send=False), options.size)
+           for i in range(min(options.batches, 200))]
+    for payload in raw:
+        for action in payload['batch']:
+            action['properties']['Listened At'] = datetime.now()
+    legacy = lambda data: json.dumps(data, cls=DatetimeSerializer)
+
+    results = [('json (hook)', measure(legacy, raw), len(raw))]
+
+    for cls in serializers:
+        try:
+            serializer = cls()
+        except ImportError:
+            print '%-12s not installed' % cls.name
+            continue
+        results.append((cls.name, measure(serializer.dumps, payloads),
+                        len(payloads)))
+
+    for name, (duration, size), count in results:
+        print '%-12s %8.0f batches/s %10.0f events/s %8d bytes/batch' % (
+            name, count / duration, count * options.size / duration,
+            size / count)
+
+
+if __name__ == '__main__':
+    main()
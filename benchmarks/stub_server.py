@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""A local stand-in for the Segment.io batch endpoint.
+
+It accepts batches like the real API and can simulate latency, server
+errors, throttling and slow reads. Run it alone to point other processes
+at it:
+
+    python benchmarks/stub_server.py --port 8765 --latency 0.05
+"""
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from optparse import OptionParser
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from segmentio import options
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # headers are written line by line, don't let Nagle hold them back
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        slow_read = self.server.stub.slow_read
+
+        if not slow_read:
+            return self.rfile.read(length)
+
+        # trickle the body in so the client sees a slow upload
+        chunks = []
+        while length > 0:
+            chunk = self.rfile.read(min(length, 4096))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            length -= len(chunk)
+            time.sleep(slow_read)
+        return ''.join(chunks)
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.read_body()
+
+        if self.path != options.endpoints['batch']:
+            return self.respond(404, '{}')
+
+        if stub.latency:
+            time.sleep(stub.latency)
+
+        roll = random.random()
+        if roll < stub.error_rate:
+            stub.record_response(500)
+            return self.respond(500, '{"error": "stub error"}')
+        if roll < stub.error_rate + stub.throttle_rate:
+            stub.record_response(429)
+            return self.respond(429, '{"error": "rate limited"}')
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            stub.record_response(400)
+            return self.respond(400, json.dumps({'error': {
+                'code': 'bad_request', 'message': 'Invalid JSON'}}))
+
+        stub.record_batch(data, len(body))
+        self.respond(200, '{}')
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubServer(object):
+    """Serves options.endpoints['batch'] on a local port from a background
+    thread, keeping counts of what it received.
+
+    :param float latency: Seconds to wait before answering each request
+    :param float error_rate: Fraction of requests answered with a 500
+    :param float throttle_rate: Fraction of requests answered with a 429
+    :param float slow_read: Seconds to wait between 4KB reads of a body
+    :param bool keep_batches: True to keep every decoded batch in received
+    """
+
+    def __init__(self, port=0, latency=0, error_rate=0, throttle_rate=0,
+                 slow_read=0, keep_batches=False):
+        self.keep_batches = keep_batches
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.slow_read = slow_read
+
+        self.lock = threading.Lock()
+        self.reset()
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+        self.server.stub = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def reset(self):
+        with self.lock:
+            self.batches = 0
+            self.events = 0
+            self.bytes = 0
+            self.responses = {}
+            self.received = []
+            # seconds between an event's properties.sentAt and its arrival
+            self.delivery_latencies = []
+
+    def record_response(self, code):
+        with self.lock:
+            self.responses[code] = self.responses.get(code, 0) + 1
+
+    def record_batch(self, data, size):
+        now = time.time()
+        batch = data.get('batch', [])
+
+        with self.lock:
+            self.responses[200] = self.responses.get(200, 0) + 1
+            self.batches += 1
+            self.events += len(batch)
+            self.bytes += size
+            if self.keep_batches:
+                self.received.append(data)
+
+            for action in batch:
+                sent_at = action.get('properties', {}).get('sentAt')
+                if sent_at is not None:
+                    self.delivery_latencies.append(now - sent_at)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--port', type='int', default=8765)
+    parser.add_option('--latency', type='float', default=0)
+    parser.add_option('--error-rate', type='float', default=0)
+    parser.add_option('--throttle-rate', type='float', default=0)
+    parser.add_option('--slow-read', type='float', default=0)
+    opts, args = parser.parse_args()
+
+    stub = StubServer(opts.port, opts.latency, opts.error_rate,
+                      opts.throttle_rate, opts.slow_read).start()
+    print 'Serving %s%s' % (stub.url, options.endpoints['batch'])
+
+    try:
+        while True:
+            time.sleep(5)
+            print '%d batches, %d events, responses %s' % (
+                stub.batches, stub.events, stub.responses)
+    except KeyboardInterrupt:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -42,6 +42,34 @@ def init(secret, **kwargs):
     setattr(this_module, 'default_client', default_client)
 
 
+def fire_once(secret, action, **kwargs):
+    """Sends a single identify, track or alias right away on the calling
+    thread, for short-lived processes that send one event and exit. It
+    leaves the default client alone and doesn't import requests.
+
+    :param str secret: The Segment.io API Secret
+
+    :param str action: 'identify', 'track' or 'alias'
+
+    Kwargs are the arguments of the action, e.g.
+    fire_once(secret, 'track', user_id='1', event='Ran Report')
+
+    Returns True if the event was accepted by the server.
+    """
+    from client import Client
+    from transport import StdlibHTTPTransport
+
+    if action not in ('identify', 'track', 'alias'):
+        raise Exception('Action must be identify, track or alias.')
+
+    client = Client(secret=secret, async=False, flush_at=1,
+                    stats=Statistics(), transport=StdlibHTTPTransport(),
+                    serializer='json')
+    getattr(client, action)(**kwargs)
+
+    return client.stats.successful == 1
+
+
 def _get_default_client():
     default_client = None
     if hasattr(this_module, 'default_client'):
@@ -52,7 +80,8 @@ def _get_default_client():
     return default_client
 
 
-def identify(user_id=None, traits={}, context={}, timestamp=None):
+def identify(user_id=None, traits={}, context={}, timestamp=None,
+             lane=None):
     """Identifying a user ties all of their actions to an id, and
     associates user traits to that id.
 
@@ -72,15 +101,19 @@ def identify(user_id=None, traits={}, context={}, timestamp=None):
     past, the timestamp  can be used to designate when the identification
     happened.  Careful with this one,  if it just happened, leave it None.
     If you do choose to provide a timestamp, make sure it has a timezone.
+
+    :param str lane: The queue lane to send this action through, see the
+    lanes argument of the Client. Leave it None for the default lane.
     """
     default_client = _get_default_client()
     if default_client:
         default_client.identify(user_id=user_id, traits=traits,
-                                context=context, timestamp=timestamp)
+                                context=context, timestamp=timestamp,
+                                lane=lane)
 
 
 def track(user_id=None, event=None, properties={}, context={},
-          timestamp=None):
+          timestamp=None, lane=None):
     """Whenever a user triggers an event, you'll want to track it.
 
     :param str user_id:  the user's id after they are logged in. It's the
@@ -104,15 +137,18 @@ def track(user_id=None, event=None, properties={}, context={},
     happened.  Careful with this one,  if it just happened, leave it None.
     If you do choose to provide a timestamp, make sure it has a timezone.
 
+    :param str lane: The queue lane to send this action through, see the
+    lanes argument of the Client. Leave it None for the default lane.
+
     """
     default_client = _get_default_client()
     if default_client:
         default_client.track(user_id=user_id, event=event,
                              properties=properties, context=context,
-                             timestamp=timestamp)
+                             timestamp=timestamp, lane=lane)
 
 
-def alias(from_id, to_id, context={}, timestamp=None):
+def alias(from_id, to_id, context={}, timestamp=None, lane=None):
     """Aliases an anonymous user into an identified user
 
     :param str from_id: the anonymous user's id before they are logged in
@@ -127,11 +163,14 @@ def alias(from_id, to_id, context={}, timestamp=None):
     the timestamp   can be used to designate when the identification
     happened.  Careful with this one,  if it just happened, leave it None.
     If you do choose to provide a timestamp, make sure it has a timezone.
+
+    :param str lane: The queue lane to send this action through, see the
+    lanes argument of the Client. Leave it None for the default lane.
     """
     default_client = _get_default_client()
     if default_client:
         default_client.alias(from_id=from_id, to_id=to_id, context=context,
-                             timestamp=timestamp)
+                             timestamp=timestamp, lane=lane)
 
 
 def flush(async=None):
@@ -164,3 +203,14 @@ def on_failure(callback):
     default_client = _get_default_client()
     if default_client:
         default_client.on_failure(callback)
+
+
+def on_dead_letter(callback):
+    """
+    Assign a callback to fire for each action rejected by the server
+
+    :param func callback: Called as callback(action, error, attempts)
+    """
+    default_client = _get_default_client()
+    if default_client:
+        default_client.on_dead_letter(callback)
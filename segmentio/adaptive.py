@@ -0,0 +1,92 @@
+from datetime import timedelta
+
+from utils import total_seconds
+
+
+class AdaptiveController(object):
+    """Tunes a client's batch size and flush interval from how its requests
+    go, additive increase / multiplicative decrease style.
+
+    While requests succeed within target_latency, batches grow by
+    batch_step whenever a full batch was sent, and the flush interval
+    shrinks by interval_step so quiet periods flush sooner. A failed or
+    slow request halves the batch size and doubles the interval. A queue
+    that grew while a batch was being sent also halves the interval.
+
+    flush_at always follows the batch size, so full batches are flushed.
+
+    """
+
+    def __init__(self, min_batch=10, max_batch=500, batch_step=10,
+                 min_interval=timedelta(seconds=1),
+                 max_interval=timedelta(seconds=60),
+                 interval_step=timedelta(seconds=1), target_latency=1.0):
+        """
+        :param int min_batch: The smallest batch size the controller sets
+        :param int max_batch: The largest batch size the controller sets
+        :param int batch_step: How much a healthy request grows the batch
+        :param datetime.timedelta min_interval: The shortest flush_after
+        :param datetime.timedelta max_interval: The longest flush_after
+        :param datetime.timedelta interval_step: How much a healthy request
+        shortens the flush interval
+        :param float target_latency: Seconds a request may take before it
+        counts as slow
+        """
+        if min_batch < 1 or max_batch < min_batch:
+            raise Exception('Batch bounds must satisfy 1 <= min <= max.')
+
+        if max_interval < min_interval:
+            raise Exception('Interval bounds must satisfy min <= max.')
+
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.batch_step = batch_step
+
+        self.min_interval = total_seconds(min_interval)
+        self.max_interval = total_seconds(max_interval)
+        self.interval_step = total_seconds(interval_step)
+
+        self.target_latency = target_latency
+
+    def attach(self, client):
+        """ Clamps the client's current settings into the bounds """
+        client.max_flush_size = self._clamp_batch(client.max_flush_size)
+        client.flush_at = client.max_flush_size
+        self._set_interval(client, total_seconds(client.flush_after))
+
+    def _clamp_batch(self, size):
+        return max(self.min_batch, min(self.max_batch, int(size)))
+
+    def _set_interval(self, client, seconds):
+        seconds = max(self.min_interval, min(self.max_interval, seconds))
+        client.flush_after = timedelta(seconds=seconds)
+
+        client.stats.adaptive_batch_size = client.max_flush_size
+        client.stats.adaptive_flush_interval = seconds
+
+    def record(self, client, size, latency, success, depth=None):
+        """Adjusts client after a request of size actions that took latency
+        seconds. depth is the queue length before the batch was taken from
+        it, None if unknown.
+
+        """
+        batch_size = client.max_flush_size
+        interval = total_seconds(client.flush_after)
+
+        if success and latency <= self.target_latency:
+            if size >= batch_size:
+                batch_size += self.batch_step
+            interval -= self.interval_step
+            client.stats.adaptive_increases += 1
+        else:
+            batch_size //= 2
+            interval *= 2
+            client.stats.adaptive_decreases += 1
+
+        # the queue grew faster than we drained it
+        if depth is not None and len(client.queue) > depth:
+            interval /= 2
+
+        client.max_flush_size = self._clamp_batch(batch_size)
+        client.flush_at = client.max_flush_size
+        self._set_interval(client, interval)
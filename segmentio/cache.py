@@ -0,0 +1,161 @@
+import threading
+import time
+
+
+class LRUCache(object):
+    """A bounded, thread-safe mapping that evicts the least recently used
+    key once it holds more than `max_size` items.
+
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+
+        self.lock = threading.Lock()
+        self.map = {}
+
+        # circular doubly linked list of [prev, next, key, value] links,
+        # oldest right after the root, newest right before it
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+    def __len__(self):
+        return len(self.map)
+
+    def __contains__(self, key):
+        return key in self.map
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, link):
+        root = self.root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = root[0] = link
+
+    def get(self, key, default=None):
+        """ Returns the value for key and marks it as recently used """
+        with self.lock:
+            link = self.map.get(key)
+            if link is None:
+                return default
+
+            self._unlink(link)
+            self._append(link)
+            return link[3]
+
+    def set(self, key, value):
+        """ Stores value for key, evicting the oldest key if full """
+        with self.lock:
+            link = self.map.get(key)
+            if link is not None:
+                link[3] = value
+                self._unlink(link)
+                self._append(link)
+                return
+
+            link = [None, None, key, value]
+            self._append(link)
+            self.map[key] = link
+
+            if len(self.map) > self.max_size:
+                oldest = self.root[1]
+                self._unlink(oldest)
+                del self.map[oldest[2]]
+
+    def pop(self, key, default=None):
+        """ Removes key and returns its value """
+        with self.lock:
+            link = self.map.pop(key, None)
+            if link is None:
+                return default
+
+            self._unlink(link)
+            return link[3]
+
+    def clear(self):
+        with self.lock:
+            self.map.clear()
+            self.root[:] = [self.root, self.root, None, None]
+
+
+class TTLCache(LRUCache):
+    """An LRUCache whose keys also expire `ttl` seconds after they were set.
+
+    """
+
+    def __init__(self, max_size=1000, ttl=60):
+        LRUCache.__init__(self, max_size)
+        self.ttl = ttl
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def get(self, key, default=None):
+        entry = LRUCache.get(self, key)
+        if entry is None:
+            return default
+
+        value, expires_at = entry
+        if time.time() >= expires_at:
+            LRUCache.pop(self, key)
+            return default
+
+        return value
+
+    def set(self, key, value):
+        LRUCache.set(self, key, (value, time.time() + self.ttl))
+
+    def pop(self, key, default=None):
+        entry = LRUCache.pop(self, key)
+        if entry is None:
+            return default
+        return entry[0]
+
+
+class StringInterner(object):
+    """Maps equal strings onto a single canonical instance, so repeated
+    event names and property keys share memory while they sit in the queue.
+
+    Hits are plain dict lookups without a lock, only misses take it. Byte
+    strings go through the builtin intern(), sharing them with the names
+    Python already interned. Once max_size strings are held they are all
+    forgotten, rather than tracking which were least recently used.
+
+    """
+
+    def __init__(self, max_size=1000, stats=None):
+        self.max_size = max_size
+        self.stats = stats
+
+        self.lock = threading.Lock()
+        self.strings = {}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def intern(self, s):
+        canonical = self.strings.get(s)
+        if canonical is not None:
+            if self.stats is not None:
+                self.stats.intern_hits += 1
+            return canonical
+
+        if not isinstance(s, basestring):
+            return s
+
+        if type(s) is str:
+            s = intern(s)
+
+        with self.lock:
+            if len(self.strings) >= self.max_size:
+                self.strings.clear()
+            canonical = self.strings.setdefault(s, s)
+
+        if self.stats is not None:
+            self.stats.intern_misses += 1
+        return canonical
@@ -1,87 +1,31 @@
 import collections
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+import hashlib
 import json
 import logging
 import numbers
 import threading
-
-from dateutil.tz import tzutc
-import requests
+import time
 
 from stats import Statistics
-from errors import ApiError
-from utils import guess_timezone, DatetimeSerializer
-
-import options
-
-
-logging_enabled = True
-logger = logging.getLogger('analytics')
-
-
-def log(level, *args, **kwargs):
-    if logging_enabled:
-        method = getattr(logger, level)
-        method(*args, **kwargs)
-
-
-def package_exception(client, data, e):
-    log('warn', 'Segment.io request error', exc_info=True)
-    client._on_failed_flush(data, e)
-
-
-def package_response(client, data, response):
-    # TODO: reduce the complexity (mccabe)
-    if response.status_code == 200:
-        client._on_successful_flush(data, response)
-    elif response.status_code == 400:
-        content = response.text
-        try:
-            body = json.loads(content)
-
-            code = 'bad_request'
-            message = 'Bad request'
-
-            if 'error' in body:
-                error = body.error
-
-                if 'code' in error:
-                    code = error['code']
-
-                if 'message' in error:
-                    message = error['message']
-
-            client._on_failed_flush(data, ApiError(code, message))
-
-        except Exception:
-            client._on_failed_flush(data, ApiError('Bad Request', content))
-    else:
-        client._on_failed_flush(data,
-                                ApiError(response.status_code, response.text))
-
-
-def request(client, url, data):
-
-    log('debug', 'Sending request to Segment.io ...')
-    try:
+from cache import StringInterner, TTLCache
+from sampling import Sampler, RateLimiter
+from lanes import LaneQueue
+from profiling import ProfiledSerializer
+from transport import HTTPTransport
+from utils import approximate_size, guess_timezone, is_decimal, \
+    total_seconds, get_serializer, log, logger, utc, \
+    ContextHoistingSerializer, DatetimeSerializer
 
-        response = requests.post(url,
-                                 data=json.dumps(data, cls=DatetimeSerializer),
-                                 headers={'content-type': 'application/json'},
-                                 timeout=client.timeout)
 
-        log('debug', 'Finished Segment.io request.')
+class Batch(list):
+    """The actions of one request, how many requests included them and the
+    error it was rejected with, if it was
 
-        package_response(client, data, response)
-
-        return response.status_code == 200
-
-    except requests.ConnectionError as e:
-        package_exception(client, data, e)
-    except requests.Timeout as e:
-        package_exception(client, data, e)
+    """
 
-    return False
+    attempts = 1
+    rejection = None
 
 
 class FlushThread(threading.Thread):
@@ -107,7 +51,15 @@ class Client(object):
     def __init__(self, secret=None, log_level=logging.INFO, log=True,
                  flush_at=20, flush_after=timedelta(0, 10),
                  async=True, max_queue_size=10000, stats=Statistics(),
-                 timeout=10, send=True):
+                 timeout=10, send=True, intern_strings=False,
+                 intern_cache_size=1000, identify_dedup_window=None,
+                 identify_dedup_size=10000, sample_rates=None,
+                 rate_limits=None, lanes=None, serializer=None,
+                 transport=None, adaptive=None, profiler=None,
+                 bisect_rejections=True, dead_letters=None,
+                 defer_cleaning=False, coalesce_identifies=False,
+                 max_queue_bytes=None, hoist_context=False,
+                 max_bisections=64):
         """Create a new instance of a analytics-python Client
 
         :param str secret: The Segment.io API secret
@@ -126,11 +78,77 @@ class Client(object):
         Segment.io
         : param bool send: True to send requests, False to not send. False to
         turn analytics off (for testing).
+        : param bool intern_strings: True to share a single instance of
+        repeated event names and property keys across queued actions
+        : param int intern_cache_size: The maximum number of distinct strings
+        kept by the intern cache, which is emptied once it is full
+        : param datetime.timedelta identify_dedup_window: Suppresses identify
+        calls whose user_id and traits match one enqueued within this window.
+        None (the default) sends every identify. A suppressed identify isn't
+        retried if the original one fails to send.
+        : param int identify_dedup_size: The maximum number of recent
+        identifies remembered for deduplication
+        : param dict sample_rates: Maps event names to the fraction of users
+        whose tracks of that event are sent, e.g. {'Heartbeat': 0.1}. The
+        same users are always kept.
+        : param dict rate_limits: Maps event names to the maximum number of
+        tracks of that event sent per second, e.g. {'Scrolled': 100}
+        : param dict lanes: Maps queue lane names to their weight, capacity
+        and overflow policy, e.g. {'critical': {'weight': 4}}. Actions go to
+        the 'default' lane unless identify, track or alias are given a lane.
+        : param int max_queue_size: The most actions queued. Once it is
+        reached, a new action evicts the oldest of the lightest lane lighter
+        than its own, or follows its lane's overflow.
+        : param str serializer: The JSON backend used to encode batches,
+        'json', 'simplejson' or 'ujson'. Defaults to ujson if it's
+        installed, json otherwise.
+        : param segmentio.transport.Transport transport: Where flushed
+        batches are delivered. Defaults to the Segment.io API over HTTP;
+        FileTransport and MemoryTransport keep them locally instead.
+        : param segmentio.adaptive.AdaptiveController adaptive: Tunes
+        max_flush_size and flush_after within its bounds from the latency
+        and errors of each request. It also sets flush_at to the batch size
+        it picks, overriding the flush_at given. None keeps them fixed.
+        : param segmentio.profiling.Profiler profiler: Times each stage of
+        identify, track, alias and flushing, and reports them to its sinks.
+        None (the default) skips all timing.
+        : param bool bisect_rejections: True to resend the halves of a batch
+        rejected with a 400 until the offending actions are isolated, which
+        then go to the on_dead_letter callbacks. False fails the whole batch.
+        : param segmentio.deadletter.DeadLetterStore dead_letters: Keeps
+        every action that fails to be delivered, to be replayed later with
+        a segmentio.deadletter.Replayer. None (the default) keeps nothing.
+        : param bool defer_cleaning: True to move cleaning properties and
+        traits and formatting timestamps from the calling thread to the
+        flush thread. Callers then only pay for validation and a shallow
+        copy of properties and traits, so values nested inside them must
+        not be mutated after the call until they are flushed. Duplicate
+        identifies are then suppressed when flushed rather than queued, so
+        they are also counted in identifies and submitted.
+        : param bool coalesce_identifies: True to merge an identify into the
+        one still queued for the same user_id, if any. Traits and context
+        of the later timestamp win, and the later timestamp is kept. Only
+        identifies for the same lane are merged.
+        : param int max_queue_bytes: The most approximate encoded bytes of
+        actions queued, further actions are dropped. None (the default)
+        bounds the queue by max_queue_size alone. Estimating sizes walks
+        each action on the calling thread.
+        : param bool hoist_context: True to send the context items shared by
+        every action of a batch once, as the batch's context, instead of in
+        each action. The API merges it back into each action's context.
+        This trades CPU for bytes: contexts are compared in Python while
+        encoding, which can take longer than encoding the bytes saved,
+        unless actions share their context dicts.
+        : param int max_bisections: The most requests made bisecting one
+        rejected batch. Actions not isolated by then fail without going to
+        the on_dead_letter callbacks, which bounds the requests spent on a
+        batch rejected as a whole, e.g. for a bad secret.
         """
 
         self.secret = secret
 
-        self.queue = collections.deque()
+        self.queue = LaneQueue(lanes, max_bytes=max_queue_bytes,
+                               max_size=max_queue_size)
         self.last_flushed = None
 
         if not log:
@@ -143,7 +161,7 @@ class Client(object):
 
         self.async = async
 
-        self.max_queue_size = max_queue_size
+        self.max_queue_bytes = max_queue_bytes
         self.max_flush_size = 50
 
         self.flush_at = flush_at
@@ -151,6 +169,16 @@ class Client(object):
 
         self.timeout = timeout
 
+        self.serializer = get_serializer(serializer)
+        if hoist_context:
+            self.serializer = ContextHoistingSerializer(self.serializer)
+
+        self.profiler = profiler
+        if profiler is not None:
+            self.serializer = ProfiledSerializer(self.serializer, profiler)
+
+        self.transport = transport or HTTPTransport()
+
         self.stats = stats
 
         self.flush_lock = threading.Lock()
@@ -158,8 +186,49 @@ class Client(object):
 
         self.send = send
 
+        self.adaptive = adaptive
+        if adaptive is not None:
+            adaptive.attach(self)
+
         self.success_callbacks = []
         self.failure_callbacks = []
+        self.dead_letter_callbacks = []
+
+        self.bisect_rejections = bisect_rejections
+        self.max_bisections = max_bisections
+        self.dead_letters = dead_letters
+        self.defer_cleaning = defer_cleaning
+
+        # user_id -> [queued identify, its timestamp], while still queued
+        self.pending_identifies = None
+        self.pending_lock = threading.RLock()
+        if coalesce_identifies:
+            self.pending_identifies = {}
+
+        self.interner = None
+        if intern_strings:
+            self.interner = StringInterner(intern_cache_size, stats)
+
+        self.recent_identifies = None
+        if identify_dedup_window is not None:
+            self.recent_identifies = TTLCache(
+                identify_dedup_size, total_seconds(identify_dedup_window))
+
+        self.sampler = None
+        if sample_rates:
+            self.sampler = Sampler(sample_rates)
+
+        self.rate_limiter = None
+        if rate_limits:
+            self.rate_limiter = RateLimiter(rate_limits)
+
+    @property
+    def max_queue_size(self):
+        return self.queue.max_size
+
+    @max_queue_size.setter
+    def max_queue_size(self, max_queue_size):
+        self.queue.max_size = max_queue_size
 
     def set_log_level(self, level):
         """Sets the log level for analytics-python
@@ -183,6 +252,8 @@ class Client(object):
     def _clean_dict(self, d):
         data = {}
         for k, v in d.iteritems():
+            if self.interner is not None:
+                k = self.interner.intern(k)
             try:
                 data[k] = self._clean(v)
             except TypeError:
@@ -192,8 +263,14 @@ class Client(object):
         return data
 
     def _clean(self, item):
-        if isinstance(item, (str, unicode, int, long, float, bool,
-                             numbers.Number, datetime)):
+        if isinstance(item, (str, unicode, int, long, float, bool)):
+            return item
+        # leave only JSON native values, so serializers never need a hook
+        elif isinstance(item, (datetime, date)):
+            return item.isoformat()
+        elif isinstance(item, numbers.Number):
+            if is_decimal(item):
+                return float(item)
             return item
         elif isinstance(item, (set, list, tuple)):
             return self._clean_list(item)
@@ -202,6 +279,54 @@ class Client(object):
         else:
             return self._coerce_unicode(item)
 
+    def _identify_key(self, user_id, cleaned_traits):
+        """The key of an identify in recent_identifies, a digest rather than
+        hash() so different traits never collide
+
+        """
+        traits = json.dumps(cleaned_traits, sort_keys=True,
+                            cls=DatetimeSerializer)
+        if isinstance(traits, unicode):
+            traits = traits.encode('utf-8')
+        return (user_id, hashlib.sha1(traits).digest())
+
+    def _snapshot(self, d):
+        """ A shallow copy of d, to be cleaned when flushed """
+        if d is None:
+            return None
+        return dict(d)
+
+    def _prepare_batch(self, batch):
+        """Cleans and formats a batch queued with defer_cleaning, dropping
+        duplicate identifies
+
+        """
+        prepared = Batch()
+        for action in batch:
+            if 'properties' in action:
+                action['properties'] = self._clean(action['properties'])
+
+            if 'traits' in action:
+                action['traits'] = self._clean(action['traits'])
+
+                if self.recent_identifies is not None:
+                    key = self._identify_key(action['userId'],
+                                             action['traits'])
+                    if key in self.recent_identifies:
+                        log('debug', 'Suppressed duplicate identify.')
+                        # it stays counted as queued, counters never go down
+                        self.stats.identifies_suppressed += 1
+                        continue
+                    self.recent_identifies.set(key, True)
+
+            action['timestamp'] = action['timestamp'].isoformat()
+            prepared.append(action)
+
+        return prepared
+
+    def _count_dropped(self, counts, event):
+        counts[event] = counts.get(event, 0) + 1
+
     def on_success(self, callback):
         """
         Assign a callback to fire after a successful flush
@@ -218,7 +343,18 @@ class Client(object):
         """
         self.failure_callbacks.append(callback)
 
-    def identify(self, user_id=None, traits={}, context={}, timestamp=None):
+    def on_dead_letter(self, callback):
+        """
+        Assign a callback to fire for each action that was rejected on its
+        own, after bisecting the batch it was in
+
+        :param func callback: Called as callback(action, error, attempts),
+        attempts being the number of requests that included the action
+        """
+        self.dead_letter_callbacks.append(callback)
+
+    def identify(self, user_id=None, traits={}, context={}, timestamp=None,
+                 lane=None):
         """Identifying a user ties all of their actions to an id, and
         associates user traits to that id.
 
@@ -238,8 +374,13 @@ class Client(object):
         past, the timestamp  can be used to designate when the identification
         happened.  Careful with this one,  if it just happened, leave it None.
         If you do choose to provide a timestamp, make sure it has a timezone.
+
+        :param str lane: The queue lane to send this action through, see the
+        lanes argument of the Client. Leave it None for the default lane.
         """
 
+        watch = self.profiler and self.profiler.stopwatch()
+
         self._check_for_secret()
 
         if not user_id:
@@ -251,28 +392,64 @@ class Client(object):
         if context is not None and not isinstance(context, dict):
             raise Exception('Context must be a dictionary.')
 
+        if watch is not None:
+            watch.lap('validate')
+
         if timestamp is None:
-            timestamp = datetime.utcnow().replace(tzinfo=tzutc())
+            timestamp = datetime.utcnow().replace(tzinfo=utc)
         elif not isinstance(timestamp, datetime):
             raise Exception('Timestamp must be a datetime object.')
         else:
             timestamp = guess_timezone(timestamp)
 
-        cleaned_traits = self._clean(traits)
+        if watch is not None:
+            watch.lap('timestamp')
+
+        if self.defer_cleaning:
+            cleaned_traits = self._snapshot(traits)
+        else:
+            cleaned_traits = self._clean(traits)
+
+            if self.recent_identifies is not None:
+                key = self._identify_key(user_id, cleaned_traits)
+                if key in self.recent_identifies:
+                    log('debug', 'Suppressed duplicate identify.')
+                    self.stats.identifies_suppressed += 1
+                    return
+
+        if watch is not None:
+            watch.lap('clean')
 
         action = {'userId':      user_id,
                   'traits':      cleaned_traits,
                   'context':     context,
-                  'timestamp':   timestamp.isoformat(),
+                  'timestamp':   timestamp,
                   'action':      'identify'}
 
+        if not self.defer_cleaning:
+            action['timestamp'] = timestamp.isoformat()
+
         context['library'] = 'analytics-python'
 
-        if self._enqueue(action):
+        if self.pending_identifies is not None:
+            queued = self._enqueue_identify(action, timestamp, lane)
+        else:
+            queued = self._enqueue(action, lane)
+
+        if queued:
             self.stats.identifies += 1
 
+            # only what was queued suppresses its duplicates
+            if self.recent_identifies is not None and \
+                    not self.defer_cleaning:
+                self.recent_identifies.set(key, True)
+
+        if watch is not None:
+            watch.lap('enqueue')
+            watch.finish('identify')
+
     def track(self, user_id=None, event=None, properties={}, context={},
-              timestamp=None):
+              timestamp=None, lane=None):
         """Whenever a user triggers an event, you'll want to track it.
 
         :param str user_id:  the user's id after they are logged in. It's the
@@ -296,8 +473,13 @@ class Client(object):
         happened.  Careful with this one,  if it just happened, leave it None.
         If you do choose to provide a timestamp, make sure it has a timezone.
 
+        :param str lane: The queue lane to send this action through, see the
+        lanes argument of the Client. Leave it None for the default lane.
+
         """
 
+        watch = self.profiler and self.profiler.stopwatch()
+
         self._check_for_secret()
 
         if not user_id:
@@ -313,28 +495,59 @@ class Client(object):
         if context is not None and not isinstance(context, dict):
             raise Exception('Context must be a dictionary.')
 
-        if timestamp is None:
-            timestamp = datetime.utcnow().replace(tzinfo=tzutc())
-        elif not isinstance(timestamp, datetime):
+        if timestamp is not None and not isinstance(timestamp, datetime):
             raise Exception('Timestamp must be a datetime.datetime object.')
+
+        if self.sampler is not None and \
+                not self.sampler.keep(event, user_id):
+            self._count_dropped(self.stats.sampled_out, event)
+            return
+
+        if self.rate_limiter is not None and \
+                not self.rate_limiter.allow(event):
+            self._count_dropped(self.stats.rate_limited, event)
+            return
+
+        if watch is not None:
+            watch.lap('validate')
+
+        if timestamp is None:
+            timestamp = datetime.utcnow().replace(tzinfo=utc)
         else:
             timestamp = guess_timezone(timestamp)
 
-        cleaned_properties = self._clean(properties)
+        if watch is not None:
+            watch.lap('timestamp')
+
+        if self.interner is not None:
+            event = self.interner.intern(event)
+
+        if self.defer_cleaning:
+            cleaned_properties = self._snapshot(properties)
+        else:
+            cleaned_properties = self._clean(properties)
+            timestamp = timestamp.isoformat()
+
+        if watch is not None:
+            watch.lap('clean')
 
         action = {'userId':       user_id,
                   'event':        event,
                   'context':      context,
                   'properties':   cleaned_properties,
-                  'timestamp':    timestamp.isoformat(),
+                  'timestamp':    timestamp,
                   'action':       'track'}
 
         context['library'] = 'analytics-python'
 
-        if self._enqueue(action):
+        if self._enqueue(action, lane):
             self.stats.tracks += 1
 
-    def alias(self, from_id, to_id, context={}, timestamp=None):
+        if watch is not None:
+            watch.lap('enqueue')
+            watch.finish('track')
+
+    def alias(self, from_id, to_id, context={}, timestamp=None, lane=None):
         """Aliases an anonymous user into an identified user
 
         :param str from_id: the anonymous user's id before they are logged in
@@ -349,8 +562,13 @@ class Client(object):
         the timestamp   can be used to designate when the identification
         happened.  Careful with this one,  if it just happened, leave it None.
         If you do choose to provide a timestamp, make sure it has a timezone.
+
+        :param str lane: The queue lane to send this action through, see the
+        lanes argument of the Client. Leave it None for the default lane.
         """
 
+        watch = self.profiler and self.profiler.stopwatch()
+
         self._check_for_secret()
 
         if not from_id:
@@ -362,24 +580,112 @@ class Client(object):
         if context is not None and not isinstance(context, dict):
             raise Exception('Context must be a dictionary.')
 
+        if watch is not None:
+            watch.lap('validate')
+
         if timestamp is None:
-            timestamp = datetime.utcnow().replace(tzinfo=tzutc())
+            timestamp = datetime.utcnow().replace(tzinfo=utc)
         elif not isinstance(timestamp, datetime):
             raise Exception('Timestamp must be a datetime.datetime object.')
         else:
             timestamp = guess_timezone(timestamp)
 
+        if not self.defer_cleaning:
+            timestamp = timestamp.isoformat()
+
+        if watch is not None:
+            watch.lap('timestamp')
+
         action = {'from':         from_id,
                   'to':           to_id,
                   'context':      context,
-                  'timestamp':    timestamp.isoformat(),
+                  'timestamp':    timestamp,
                   'action':       'alias'}
 
         context['library'] = 'analytics-python'
 
-        if self._enqueue(action):
+        if self._enqueue(action, lane):
             self.stats.aliases += 1
 
+        if watch is not None:
+            watch.lap('enqueue')
+            watch.finish('alias')
+
+    def _enqueue_identify(self, action, timestamp, lane=None):
+        """Merges an identify into the one queued for the same user, or
+        queues it and indexes it by user_id
+
+        Returns whether a new action was queued.
+        """
+        user_id = action['userId']
+        lane = self.queue.lane(lane).name
+
+        with self.pending_lock:
+            pending = self.pending_identifies.get(user_id)
+            if pending is not None and pending[2] == lane and self.send:
+                queued = pending[0]
+                merged = self._merge_identify(pending, action, timestamp)
+
+                if self.max_queue_bytes is not None:
+                    size = approximate_size(dict(queued, **merged))
+                    if not self.queue.resize(queued, size):
+                        self.stats.dropped += 1
+                        log('warn', 'analytics-python queue is over ' +
+                                    'max_queue_bytes')
+                        return False
+                    self.stats.queue_bytes = self.queue.bytes
+
+                if self.recent_identifies is not None and \
+                        not self.defer_cleaning:
+                    # the queued identify no longer has the traits it was
+                    # remembered by
+                    self.recent_identifies.pop(
+                        self._identify_key(user_id, queued['traits']))
+                    self.recent_identifies.set(
+                        self._identify_key(user_id, merged['traits']), True)
+
+                queued.update(merged)
+                if 'timestamp' in merged:
+                    pending[1] = timestamp
+
+                self.stats.identifies_coalesced += 1
+                return False
+
+            submitted = self._append(action, lane)
+            if submitted:
+                self.pending_identifies[user_id] = [action, timestamp, lane]
+
+        # outside the lock, a synchronous flush would hold it for a request
+        if self._should_flush():
+            self.flush()
+
+        return submitted
+
+    def _merge_identify(self, pending, action, timestamp):
+        """ Returns the fields of the queued identify merged with action """
+        queued, queued_at, lane = pending
+        newer = timestamp >= queued_at
+
+        # new dicts, the queued context is the caller's
+        merged = {}
+        for field in ('traits', 'context'):
+            values = dict(queued[field] or {})
+            for key, value in (action[field] or {}).iteritems():
+                if newer or key not in values:
+                    values[key] = value
+            merged[field] = values
+
+        if newer:
+            merged['timestamp'] = action['timestamp']
+
+        return merged
+
+    def _unindex_identify(self, action):
+        with self.pending_lock:
+            pending = self.pending_identifies.get(action['userId'])
+            if pending is not None and pending[0] is action:
+                del self.pending_identifies[action['userId']]
+
     def _should_flush(self):
         """ Determine whether we should sync """
 
@@ -391,28 +697,51 @@ class Client(object):
 
         return full or stale
 
-    def _enqueue(self, action):
+    def _enqueue(self, action, lane=None):
+
+        submitted = self._append(action, lane)
+
+        if self._should_flush():
+            self.flush()
+
+        return submitted
+
+    def _append(self, action, lane=None):
+        """ Adds an action to the queue, returns whether it was accepted """
 
         # if we've disabled sending, just return False
         if not self.send:
             return False
 
-        submitted = False
-
-        if len(self.queue) < self.max_queue_size:
-            self.queue.append(action)
+        size = 0
+        if self.max_queue_bytes is not None:
+            size = approximate_size(action)
 
+        # the queue enforces max_queue_size and max_queue_bytes
+        if self.pending_identifies is None:
+            submitted, evicted = self.queue.append(action, lane, size)
+        else:
+            # unindexed in the same step, nothing merges into it after
+            with self.pending_lock:
+                submitted, evicted = self.queue.append(action, lane, size)
+                if evicted is not None and evicted['action'] == 'identify':
+                    self._unindex_identify(evicted)
+        self.stats.queue_bytes = self.queue.bytes
+
+        if submitted:
             self.stats.submitted += 1
 
-            submitted = True
-
             log('debug', 'Enqueued ' + action['action'] + '.')
 
         else:
-            log('warn', 'analytics-python queue is full')
+            self.stats.dropped += 1
+            log('warn', 'analytics-python queue or queue lane is full, or ' +
+                        'the queue is over max_queue_bytes')
 
-        if self._should_flush():
-            self.flush()
+        if evicted is not None:
+            self.stats.dropped += 1
+            log('warn', 'Dropped the oldest ' + evicted['action'] +
+                        ' from a full analytics-python queue')
 
         return submitted
 
@@ -425,11 +754,33 @@ class Client(object):
 
     def _on_failed_flush(self, data, error):
         if 'batch' in data:
+            attempts = getattr(data['batch'], 'attempts', 1)
             for item in data['batch']:
                 self.stats.failed += 1
+                if self.dead_letters is not None:
+                    self.dead_letters.add(item, error, attempts)
                 for callback in self.failure_callbacks:
                     callback(data, error)
 
+    def _on_rejected_flush(self, data, error):
+        batch = data['batch']
+
+        if isinstance(batch, Batch):
+            batch.rejection = error
+
+            # _flush_batch bisects it once the request is done
+            if self._bisectable(batch):
+                return
+
+        if self.bisect_rejections and len(batch) == 1:
+            attempts = getattr(batch, 'attempts', 1)
+            for action in batch:
+                self.stats.dead_letters += 1
+                for callback in self.dead_letter_callbacks:
+                    callback(action, error, attempts)
+
+        self._on_failed_flush(data, error)
+
     def _flush_thread_is_free(self):
         return self.flushing_thread is None \
             or not self.flushing_thread.is_alive()
@@ -447,20 +798,7 @@ class Client(object):
             async = self.async
 
         if async:
-            # We should asynchronously flush on another thread
-            with self.flush_lock:
-
-                if self._flush_thread_is_free():
-
-                    log('debug', 'Initiating asynchronous flush ..')
-
-                    self.flushing_thread = FlushThread(self)
-                    self.flushing_thread.start()
-
-                    flushing = True
-
-                else:
-                    log('debug', 'The flushing thread is still active.')
+            flushing = self._start_async_flush()
         else:
 
             # Flushes on this thread
@@ -474,6 +812,23 @@ class Client(object):
 
         return flushing
 
+    def _start_async_flush(self):
+        """ Starts flushing on another thread, returns whether it did """
+        with self.flush_lock:
+
+            if self._flush_thread_is_free():
+
+                log('debug', 'Initiating asynchronous flush ..')
+
+                self.flushing_thread = FlushThread(self)
+                self.flushing_thread.start()
+
+                return True
+
+            else:
+                log('debug', 'The flushing thread is still active.')
+                return False
+
     def _sync_flush(self):
 
         log('debug', 'Starting flush ..')
@@ -481,23 +836,125 @@ class Client(object):
         successful = 0
         failed = 0
 
-        url = options.host + options.endpoints['batch']
-
         while len(self.queue) > 0:
 
-            batch = []
-            for i in range(self.max_flush_size):
-                if len(self.queue) == 0:
-                    break
-
-                batch.append(self.queue.pop())
+            delivered, undelivered = self._flush_batch()
 
-            payload = {'batch': batch, 'secret': self.secret}
-
-            if request(self, url, payload):
-                successful += len(batch)
-            else:
-                failed += len(batch)
+            successful += delivered
+            failed += undelivered
 
         log('debug', 'Successfully flushed {0} items [{1} failed].'.
                      format(str(successful), str(failed)))
+
+    def _pop_batch(self):
+        batch = Batch()
+        for i in range(self.max_flush_size):
+            try:
+                batch.append(self.queue.popleft())
+            except IndexError:
+                break
+        return batch
+
+    def _flush_batch(self):
+        """Sends up to max_flush_size queued actions as one batch
+
+        Returns the number of actions delivered and the number that failed.
+        """
+        depth = len(self.queue)
+
+        if self.pending_identifies is None:
+            batch = self._pop_batch()
+        else:
+            # no identify can be merged into once it's been taken
+            with self.pending_lock:
+                batch = self._pop_batch()
+                for action in batch:
+                    if action['action'] == 'identify':
+                        self._unindex_identify(action)
+
+        if not batch:
+            return 0, 0
+
+        if self.max_queue_bytes is not None:
+            self.stats.queue_bytes = self.queue.bytes
+
+        if self.defer_cleaning:
+            start = time.time()
+            batch = self._prepare_batch(batch)
+            if self.profiler is not None:
+                self.profiler.record('clean', time.time() - start)
+
+            # every action was a suppressed identify
+            if not batch:
+                return 0, 0
+
+        if self._send(batch, depth):
+            return len(batch), 0
+
+        if not self._bisectable(batch):
+            return 0, len(batch)
+
+        return self._bisect(batch)
+
+    def _send(self, batch, depth=None):
+        """Sends one batch, returns whether it was delivered
+
+        :param int depth: The queue length before the batch was taken from
+        it, for the adaptive controller to tell if the queue is growing
+        """
+        payload = {'batch': batch, 'secret': self.secret}
+
+        self.stats.in_flight += 1
+        start = time.time()
+        try:
+            sent = self.transport.send(self, payload)
+        finally:
+            self.stats.in_flight -= 1
+        duration = time.time() - start
+
+        if self.profiler is not None:
+            self.profiler.record('send', duration)
+
+        # a rejected batch says nothing about the server's health
+        if self.adaptive is not None:
+            healthy = sent or batch.rejection is not None
+            self.adaptive.record(self, len(batch), duration, healthy, depth)
+
+        return sent
+
+    def _bisectable(self, batch):
+        return self.bisect_rejections and batch.rejection is not None \
+            and len(batch) > 1
+
+    def _bisect(self, batch):
+        """Resends each half of a rejected batch, splitting every rejected
+        half again until the offending actions are alone, or until
+        max_bisections requests were made for the batch. The actions of
+        halves still rejected then fail without being isolated.
+
+        Returns the number of actions delivered and the number that failed.
+        """
+        delivered = 0
+        requests = 0
+        rejected = collections.deque([batch])
+
+        while rejected and requests + 2 <= self.max_bisections:
+            parent = rejected.popleft()
+            middle = len(parent) // 2
+            for actions in (parent[:middle], parent[middle:]):
+                half = Batch(actions)
+                half.attempts = parent.attempts + 1
+
+                self.stats.bisections += 1
+                requests += 1
+                if self._send(half):
+                    delivered += len(half)
+                # single actions were reported as dead letters already
+                elif self._bisectable(half):
+                    rejected.append(half)
+
+        for half in rejected:
+            self._on_failed_flush({'batch': half, 'secret': self.secret},
+                                  half.rejection)
+
+        return delivered, len(batch) - delivered
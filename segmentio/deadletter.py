@@ -0,0 +1,353 @@
+import collections
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from optparse import OptionParser
+
+from client import Batch, Client
+from stats import Statistics
+from transport import HTTPTransport
+from utils import DatetimeSerializer
+
+
+def _record(action, error, attempts):
+    return {
+        'action': action,
+        'error': unicode(error),
+        'attempts': attempts,
+        'failed_at': datetime.utcnow().isoformat()
+    }
+
+
+class DeadLetterStore(object):
+    """Keeps actions whose delivery failed, with the error and the number of
+    attempts made, until they are replayed. Stores are bounded, the oldest
+    records are dropped (and counted in dropped) to make room.
+
+    Records are dicts of 'action', 'error', 'attempts' and 'failed_at'.
+
+    """
+
+    dropped = 0
+
+    def add(self, action, error, attempts=1):
+        """ Stores a failed action """
+        self.put(_record(action, error, attempts))
+
+    def put(self, record):
+        """ Stores a record, such as one taken but not replayed """
+        raise NotImplementedError
+
+    def take(self, count):
+        """ Removes and returns up to count of the oldest records """
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class MemoryDeadLetterStore(DeadLetterStore):
+    """ A ring of the most recent max_size records """
+
+    def __init__(self, max_size=10000):
+        self.lock = threading.Lock()
+        self.records = collections.deque(maxlen=max_size)
+
+    def put(self, record):
+        with self.lock:
+            if len(self.records) == self.records.maxlen:
+                self.dropped += 1
+            self.records.append(record)
+
+    def take(self, count):
+        with self.lock:
+            return [self.records.popleft()
+                    for i in range(min(count, len(self.records)))]
+
+    def __len__(self):
+        return len(self.records)
+
+
+class FileDeadLetterStore(DeadLetterStore):
+    """Appends records as lines of JSON to numbered segment files in a
+    directory, so they survive restarts. A segment is closed once it grows
+    past segment_bytes, and the oldest segments are deleted once there are
+    more than max_segments.
+
+    Segments are read into memory one at a time as records are taken, and
+    deleted once all of their records have been taken.
+
+    """
+
+    def __init__(self, directory, segment_bytes=10 * 1024 * 1024,
+                 max_segments=10):
+        """
+        :param str directory: Where segments are kept, created if missing
+        :param int segment_bytes: The size at which a segment is closed
+        :param int max_segments: The number of segments kept on disk
+        """
+        if max_segments < 1:
+            raise Exception('At least one segment must be kept.')
+
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.lock = threading.Lock()
+        self.file = None
+        self.path = None
+
+        # the records left of the segment being taken from
+        self.head = collections.deque()
+        self.head_path = None
+
+        # [path, records] of each segment on disk, oldest first
+        self.segments = []
+        for path in self._segments():
+            with open(path) as f:
+                self.segments.append(
+                    [path, sum(1 for line in f if line.strip())])
+
+        if self.segments:
+            self.index = int(self.segments[-1][0].rsplit('.', 1)[1]) + 1
+        else:
+            self.index = 1
+
+    def _segments(self):
+        names = [name for name in os.listdir(self.directory)
+                 if name.startswith('segment.') and
+                 name.rsplit('.', 1)[1].isdigit()]
+        names.sort(key=lambda name: int(name.rsplit('.', 1)[1]))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def _close_segment(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.path = None
+
+    def _open_segment(self):
+        self.path = os.path.join(self.directory, 'segment.%d' % self.index)
+        self.index += 1
+        self.file = open(self.path, 'a')
+        self.segments.append([self.path, 0])
+
+        # make room, never deleting the segment being taken from
+        while len(self.segments) > self.max_segments:
+            index = 1 if self.segments[0][0] == self.head_path else 0
+            path, count = self.segments.pop(index)
+            self.dropped += count
+            os.remove(path)
+
+    def put(self, record):
+        line = json.dumps(record, cls=DatetimeSerializer) + '\n'
+
+        with self.lock:
+            if self.file is None:
+                self._open_segment()
+
+            self.file.write(line)
+            self.file.flush()
+            self.segments[-1][1] += 1
+
+            if os.fstat(self.file.fileno()).st_size >= self.segment_bytes:
+                self._close_segment()
+
+    def take(self, count):
+        with self.lock:
+            records = []
+
+            while len(records) < count:
+                if not self.head:
+                    self._finish_head()
+
+                    if not self.segments:
+                        break
+
+                    self.head_path = self.segments[0][0]
+                    if self.head_path == self.path:
+                        self._close_segment()
+
+                    with open(self.head_path) as f:
+                        self.head.extend(json.loads(line)
+                                         for line in f if line.strip())
+                    continue
+
+                records.append(self.head.popleft())
+                self.segments[0][1] -= 1
+
+            if not self.head:
+                self._finish_head()
+
+            return records
+
+    def _finish_head(self):
+        if self.head_path is not None:
+            self.segments.pop(0)
+            os.remove(self.head_path)
+            self.head_path = None
+
+    def __len__(self):
+        return sum(count for path, count in self.segments)
+
+    def close(self):
+        with self.lock:
+            self._close_segment()
+
+
+class Replayer(object):
+    """Resubmits dead letters straight to a transport in large batches, at
+    most rate requests a second, bypassing the live client's queue. The
+    requests that bisect a rejected batch count against the rate too.
+
+    A batch that fails outright means the upstream hasn't recovered: its
+    records go back into the store unchanged and the replay stops. Only
+    actions rejected on their own go back with one more attempt, or are
+    discarded once they reach max_attempts.
+
+    """
+
+    def __init__(self, store, secret, transport=None, batch_size=500,
+                 rate=1.0, max_attempts=10):
+        """
+        :param segmentio.deadletter.DeadLetterStore store: Where the dead
+        letters are taken from
+        :param str secret: The Segment.io API secret they are sent with
+        :param segmentio.transport.Transport transport: Defaults to HTTP
+        with gzipped bodies
+        :param int batch_size: The number of actions per request
+        :param float rate: The most requests sent per second, None for no
+        limit
+        :param int max_attempts: The attempts after which an action that
+        still fails is discarded
+        """
+        self.store = store
+        self.batch_size = batch_size
+        self.rate = rate
+        self.max_attempts = max_attempts
+
+        # failures are collected here rather than in the live client's store
+        self.failures = MemoryDeadLetterStore(max_size=None)
+        self.client = Client(secret, log=False, async=False,
+                             stats=Statistics(),
+                             transport=transport or
+                             HTTPTransport(compress=True),
+                             dead_letters=self.failures)
+
+        # ids of the actions of a batch rejected on their own
+        self.rejected = set()
+        self.client.on_dead_letter(
+            lambda action, error, attempts: self.rejected.add(id(action)))
+
+        self.replayed = 0
+        self.discarded = 0
+        self.requests = 0
+
+    def replay_batch(self):
+        """Sends one batch of dead letters
+
+        Returns the number of actions delivered, None if there was nothing
+        to send or the whole batch failed.
+        """
+        records = self.store.take(self.batch_size)
+        if not records:
+            return None
+
+        batch = Batch(record['action'] for record in records)
+        self.rejected.clear()
+
+        stats = self.client.stats
+        successful = stats.successful
+        bisections = stats.bisections
+
+        if not self.client._send(batch) and self.client._bisectable(batch):
+            self.client._bisect(batch)
+
+        self.requests += 1 + stats.bisections - bisections
+
+        delivered = stats.successful - successful
+        self.replayed += delivered
+
+        failures = dict((id(failure['action']), failure)
+                        for failure in self.failures.take(len(self.failures)))
+        for record in records:
+            failure = failures.get(id(record['action']))
+            if failure is None:
+                continue
+
+            # an outage isn't the action's fault, it goes back as it was
+            if id(record['action']) not in self.rejected:
+                self.store.put(record)
+                continue
+
+            failure['attempts'] = record['attempts'] + 1
+            if failure['attempts'] >= self.max_attempts:
+                self.discarded += 1
+                continue
+            self.store.put(failure)
+
+        if not delivered:
+            return None
+        return delivered
+
+    def run(self, max_batches=None):
+        """Replays until the store is empty, a batch fails or max_batches
+        have been sent
+
+        Returns the number of actions delivered.
+        """
+        replayed = self.replayed
+        batches = 0
+
+        while max_batches is None or batches < max_batches:
+            start = time.time()
+            requests = self.requests
+            if self.replay_batch() is None:
+                break
+            batches += 1
+
+            if self.rate:
+                requests = self.requests - requests
+                remaining = requests / float(self.rate) - \
+                    (time.time() - start)
+                if remaining > 0:
+                    time.sleep(remaining)
+
+        return self.replayed - replayed
+
+
+def main():
+    """ Replays a FileDeadLetterStore from the command line """
+    parser = OptionParser(
+        usage='python -m segmentio.deadletter [options] SECRET DIRECTORY')
+    parser.add_option('--batch-size', type='int', default=500)
+    parser.add_option('--rate', type='float', default=1.0,
+                      help='the most requests sent per second')
+    parser.add_option('--max-batches', type='int', default=None)
+    parser.add_option('--max-attempts', type='int', default=10)
+    opts, args = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error('the secret and the dead letter directory are required')
+
+    secret, directory = args
+    store = FileDeadLetterStore(directory)
+    replayer = Replayer(store, secret, batch_size=opts.batch_size,
+                        rate=opts.rate, max_attempts=opts.max_attempts)
+    try:
+        replayer.run(opts.max_batches)
+    finally:
+        store.close()
+        replayer.client.transport.close()
+
+    print 'replayed %d discarded %d left %d' % (
+        replayer.replayed, replayer.discarded, len(store))
+
+
+if __name__ == '__main__':
+    main()
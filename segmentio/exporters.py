@@ -0,0 +1,208 @@
+import re
+import socket
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from utils import log
+
+
+# Statistics fields reported as gauges, every other number is a counter
+GAUGES = set(['in_flight', 'queue_bytes', 'adaptive_batch_size',
+              'adaptive_flush_interval'])
+
+
+def collect(stats, client=None):
+    """Returns (name, labels, value, kind) tuples for every number on stats,
+    kind being 'counter' or 'gauge'. Dict fields such as sampled_out become
+    one tuple per key, labelled by event. Given a client, its current queue
+    depth is included.
+
+    """
+    metrics = []
+
+    for name, value in sorted(vars(stats).items()):
+        kind = 'gauge' if name in GAUGES else 'counter'
+
+        if isinstance(value, dict):
+            for event, count in sorted(value.items()):
+                metrics.append((name, {'event': event}, count, kind))
+        elif isinstance(value, (int, long, float)) and \
+                not isinstance(value, bool):
+            metrics.append((name, {}, value, kind))
+
+    if client is not None:
+        metrics.append(('queue_depth', {}, len(client.queue), 'gauge'))
+
+    return metrics
+
+
+class StatsdExporter(threading.Thread):
+    """Pushes Statistics to a StatsD server over UDP every interval seconds,
+    packing as many metrics into each packet as fit.
+
+    Counters are sent as the change since the previous push.
+
+    """
+
+    def __init__(self, stats, client=None, host='127.0.0.1', port=8125,
+                 prefix='segmentio', interval=10, max_packet_size=1432):
+        """
+        :param segmentio.stats.Statistics stats: The statistics to push
+        :param segmentio.client.Client client: Optional, to push its queue
+        depth
+        :param float interval: Seconds between pushes
+        :param int max_packet_size: The largest UDP payload sent, in bytes
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.stats = stats
+        self.client = client
+        self.address = (host, port)
+        self.prefix = prefix
+        self.interval = interval
+        self.max_packet_size = max_packet_size
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.stopped = threading.Event()
+        self.previous = {}
+
+    def _name(self, name, labels):
+        parts = [self.prefix, name] + [unicode(v).encode('utf-8')
+                                       for v in labels.values()]
+        return '.'.join(re.sub(r'[^\w\-]', '_', part)
+                        for part in parts if part)
+
+    def lines(self):
+        """ The StatsD lines for the current statistics """
+        lines = []
+        for name, labels, value, kind in collect(self.stats, self.client):
+            metric = self._name(name, labels)
+
+            if kind == 'gauge':
+                lines.append('%s:%s|g' % (metric, value))
+                continue
+
+            delta = value - self.previous.get(metric, 0)
+            self.previous[metric] = value
+            if delta:
+                lines.append('%s:%s|c' % (metric, delta))
+
+        return lines
+
+    def packets(self, lines):
+        packet = []
+        size = 0
+        for line in lines:
+            if packet and size + len(line) + 1 > self.max_packet_size:
+                yield '\n'.join(packet)
+                packet = []
+                size = 0
+            packet.append(line)
+            size += len(line) + 1
+
+        if packet:
+            yield '\n'.join(packet)
+
+    def export(self):
+        """ Pushes the current statistics once """
+        for packet in self.packets(self.lines()):
+            try:
+                self.socket.sendto(packet, self.address)
+            except socket.error:
+                log('warn', 'analytics-python statsd export failed',
+                    exc_info=True)
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.stopped.wait(self.interval)
+            self.export()
+
+    def stop(self):
+        """ Pushes a last time and stops the thread, if it was started """
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        else:
+            self.export()
+        self.socket.close()
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('\n', '\\n') \
+        .replace('"', '\\"').encode('utf-8')
+
+
+class PrometheusHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.exporter.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class PrometheusExporter(object):
+    """Serves Statistics in the Prometheus text format at /metrics from a
+    local HTTP listener on a background thread.
+
+    """
+
+    def __init__(self, stats, client=None, host='127.0.0.1', port=9464,
+                 prefix='segmentio'):
+        """
+        :param segmentio.stats.Statistics stats: The statistics to serve
+        :param segmentio.client.Client client: Optional, to serve its queue
+        depth
+        :param int port: The port to listen on, 0 to pick a free one
+        """
+        self.stats = stats
+        self.client = client
+        self.prefix = prefix
+
+        self.server = HTTPServer((host, port), PrometheusHandler)
+        self.server.exporter = self
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def render(self):
+        """ The current statistics in the Prometheus text format """
+        lines = []
+        typed = set()
+
+        for name, labels, value, kind in collect(self.stats, self.client):
+            metric = '%s_%s' % (self.prefix, name)
+            if metric not in typed:
+                typed.add(metric)
+                lines.append('# TYPE %s %s' % (metric, kind))
+
+            if labels:
+                metric += '{%s}' % ','.join(
+                    '%s="%s"' % (k, _escape(v))
+                    for k, v in sorted(labels.items()))
+
+            lines.append('%s %s' % (metric, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
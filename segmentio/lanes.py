@@ -0,0 +1,199 @@
+import collections
+import threading
+
+
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+
+
+class Lane(object):
+    """A FIFO lane of queued actions.
+
+    :param int weight: How many actions this lane gets drained for every
+    one action of a lane with weight 1, while both have actions waiting
+    :param int capacity: The maximum number of actions waiting in this lane,
+    None for no limit other than the client's max_queue_size
+    :param str overflow: What to do with a new action when the lane is full,
+    'drop_newest' to reject it or 'drop_oldest' to evict the lane's oldest.
+    When the whole queue is full, a new action evicts the oldest of the
+    lightest lane lighter than its own instead, and otherwise follows its
+    lane's overflow.
+    """
+
+    def __init__(self, name, weight=1, capacity=None, overflow=DROP_NEWEST):
+        if weight < 1:
+            raise Exception('Lane weight must be at least 1.')
+
+        if overflow not in (DROP_NEWEST, DROP_OLDEST):
+            raise Exception('Lane overflow must be "%s" or "%s".'
+                            % (DROP_NEWEST, DROP_OLDEST))
+
+        self.name = name
+        self.weight = weight
+        self.capacity = capacity
+        self.overflow = overflow
+
+        self.actions = collections.deque()
+        # smooth weighted round robin credit
+        self.credit = 0
+
+
+class LaneQueue(object):
+    """A queue made of named priority lanes, drained by weight so that
+    critical actions keep moving when the queue is saturated.
+
+    """
+
+    def __init__(self, lanes=None, default='default', max_bytes=None,
+                 max_size=None):
+        """
+        :param dict lanes: Maps lane names to a dict of Lane keyword
+        arguments, e.g. {'critical': {'weight': 4}}
+        :param str default: The lane used when none is given, created with
+        the default Lane settings if it isn't in lanes
+        :param int max_bytes: The most bytes of the sizes given to append
+        queued at once, None for no limit
+        :param int max_size: The most actions queued across every lane,
+        None for no limit
+        """
+        self.lock = threading.Lock()
+
+        # approximate encoded bytes of each queued action, by id, if given
+        self.sizes = {}
+        self.bytes = 0
+        self.max_bytes = max_bytes
+        self.max_size = max_size
+
+        self.lanes = {}
+        for name, settings in (lanes or {}).iteritems():
+            self.lanes[name] = Lane(name, **settings)
+
+        if default not in self.lanes:
+            self.lanes[default] = Lane(default)
+        self.default = default
+
+        # drain order for ties: heaviest lanes first
+        self.ordered = sorted(self.lanes.values(),
+                              key=lambda lane: -lane.weight)
+
+    def __len__(self):
+        return sum(len(lane.actions) for lane in self.ordered)
+
+    def __iter__(self):
+        for lane in self.ordered:
+            for action in list(lane.actions):
+                yield action
+
+    def lane(self, name=None):
+        if name is None:
+            name = self.default
+
+        if name not in self.lanes:
+            raise Exception('Unknown queue lane "%s".' % name)
+
+        return self.lanes[name]
+
+    def append(self, action, lane=None, size=0):
+        """Adds an action to the back of a lane
+
+        :param int size: The approximate encoded bytes of the action, added
+        to bytes while it is queued
+
+        Returns a tuple of whether the action was accepted, and the action
+        evicted to make room for it if any.
+        """
+        lane = self.lane(lane)
+
+        with self.lock:
+            # the lane the oldest action is evicted from, if any
+            victim = None
+
+            if lane.capacity is not None and \
+                    len(lane.actions) >= lane.capacity:
+                if lane.overflow == DROP_NEWEST or lane.capacity < 1:
+                    return False, None
+                victim = lane
+
+            elif self.max_size is not None and \
+                    len(self) >= self.max_size:
+                victim = self._victim(lane)
+                if victim is None:
+                    return False, None
+
+            evicted = None
+            if victim is not None:
+                evicted = victim.actions[0]
+
+            # counting the room the eviction makes
+            if self.max_bytes is not None:
+                freed = 0
+                if evicted is not None:
+                    freed = self.sizes.get(id(evicted), 0)
+                if self.bytes - freed + size > self.max_bytes:
+                    return False, None
+
+            if victim is not None:
+                self._forget(victim.actions.popleft())
+
+            lane.actions.append(action)
+            if size:
+                self.sizes[id(action)] = size
+                self.bytes += size
+            return True, evicted
+
+    def _victim(self, lane):
+        """ The lane to evict from to make room for lane in a full queue """
+        for other in reversed(self.ordered):
+            if other.weight >= lane.weight:
+                break
+            if other.actions:
+                return other
+
+        if lane.overflow == DROP_OLDEST and lane.actions:
+            return lane
+        return None
+
+    def resize(self, action, size):
+        """Updates the size of an action still queued
+
+        Returns False, leaving it as it was, if the new size doesn't fit
+        under max_bytes.
+        """
+        with self.lock:
+            if id(action) not in self.sizes:
+                return True
+
+            total = self.bytes + size - self.sizes[id(action)]
+            if self.max_bytes is not None and total > self.max_bytes:
+                return False
+
+            self.bytes = total
+            self.sizes[id(action)] = size
+            return True
+
+    def _forget(self, action):
+        size = self.sizes.pop(id(action), None)
+        if size is not None:
+            self.bytes -= size
+        return action
+
+    def popleft(self):
+        """ Removes the next action by lane weight, FIFO within a lane """
+        with self.lock:
+            waiting = [lane for lane in self.ordered if lane.actions]
+            if not waiting:
+                raise IndexError('pop from an empty queue')
+
+            if len(waiting) == 1:
+                return self._forget(waiting[0].actions.popleft())
+
+            total = 0
+            selected = None
+            for lane in waiting:
+                lane.credit += lane.weight
+                total += lane.weight
+                if selected is None or lane.credit > selected.credit:
+                    selected = lane
+
+            selected.credit -= total
+            return self._forget(selected.actions.popleft())
@@ -0,0 +1,148 @@
+import collections
+import random
+import threading
+import time
+
+# python 2 has no monotonic clock in the standard library
+timer = getattr(time, 'monotonic', time.time)
+
+
+class Sink(object):
+    """Receives stage timings from a Profiler. Subclasses override record,
+    trace or both.
+
+    """
+
+    def record(self, stage, seconds):
+        """ Called with the duration of every timed stage """
+        pass
+
+    def trace(self, action, laps):
+        """Called for sampled events with the action name and a list of
+        (stage, seconds) tuples in the order the stages ran
+
+        """
+        pass
+
+
+class CallbackSink(Sink):
+    """ Forwards timings to plain functions """
+
+    def __init__(self, on_record=None, on_trace=None):
+        """
+        :param func on_record: Called as on_record(stage, seconds)
+        :param func on_trace: Called as on_trace(action, laps)
+        """
+        self.on_record = on_record
+        self.on_trace = on_trace
+
+    def record(self, stage, seconds):
+        if self.on_record is not None:
+            self.on_record(stage, seconds)
+
+    def trace(self, action, laps):
+        if self.on_trace is not None:
+            self.on_trace(action, laps)
+
+
+class AggregateSink(Sink):
+    """ Keeps count, total, min and max per stage and the latest traces """
+
+    def __init__(self, max_traces=100):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.traces = collections.deque(maxlen=max_traces)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            totals = self.stages.get(stage)
+            if totals is None:
+                self.stages[stage] = [1, seconds, seconds, seconds]
+                return
+
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = min(totals[2], seconds)
+            totals[3] = max(totals[3], seconds)
+
+    def trace(self, action, laps):
+        self.traces.append((action, laps))
+
+    def snapshot(self):
+        """Returns {stage: {'count', 'total', 'mean', 'min', 'max'}} with
+        durations in seconds
+
+        """
+        with self.lock:
+            return dict((stage, {'count': count, 'total': total,
+                                 'mean': total / count, 'min': low,
+                                 'max': high})
+                        for stage, (count, total, low, high)
+                        in self.stages.iteritems())
+
+
+class Stopwatch(object):
+    """ Times consecutive stages of one event """
+
+    def __init__(self, profiler, tracing):
+        self.profiler = profiler
+        self.laps = [] if tracing else None
+        self.last = timer()
+
+    def lap(self, stage):
+        """ Records the time since the previous lap as stage """
+        now = timer()
+        seconds = now - self.last
+        self.last = now
+
+        self.profiler.record(stage, seconds)
+        if self.laps is not None:
+            self.laps.append((stage, seconds))
+
+    def finish(self, action):
+        if self.laps is not None:
+            for sink in self.profiler.sinks:
+                sink.trace(action, self.laps)
+
+
+class Profiler(object):
+    """Times the stages of the event pipeline and reports them to sinks.
+
+    The caller thread stages are 'validate', 'timestamp', 'clean' and
+    'enqueue'. The flush stages, timed once per batch, are 'encode' and
+    'send', which includes the encoding, and 'clean' for clients that
+    defer cleaning to the flush thread.
+
+    """
+
+    def __init__(self, sinks=None, trace_rate=0.0):
+        """
+        :param list sinks: The Sinks timings are reported to
+        :param float trace_rate: The fraction of events whose stages are
+        also reported together as a trace
+        """
+        self.sinks = list(sinks or [])
+        self.trace_rate = trace_rate
+
+    def record(self, stage, seconds):
+        for sink in self.sinks:
+            sink.record(stage, seconds)
+
+    def stopwatch(self):
+        tracing = self.trace_rate > 0 and random.random() < self.trace_rate
+        return Stopwatch(self, tracing)
+
+
+class ProfiledSerializer(object):
+    """ Wraps a serializer to time each batch it encodes as 'encode' """
+
+    def __init__(self, serializer, profiler):
+        self.serializer = serializer
+        self.profiler = profiler
+        self.name = getattr(serializer, 'name', None)
+
+    def dumps(self, obj):
+        start = timer()
+        encoded = self.serializer.dumps(obj)
+        self.profiler.record('encode', timer() - start)
+        return encoded
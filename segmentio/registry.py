@@ -0,0 +1,184 @@
+import collections
+import threading
+import time
+from datetime import datetime
+
+from client import Client
+from stats import Statistics
+from transport import HTTPTransport
+from utils import log
+
+
+class TenantClient(Client):
+    """A Client whose asynchronous flushes run on its Registry's shared
+    workers instead of a thread of its own.
+
+    """
+
+    def __init__(self, registry, secret, **kwargs):
+        self.registry = registry
+        Client.__init__(self, secret=secret, **kwargs)
+
+    def _start_async_flush(self):
+        self.registry._schedule(self)
+        return True
+
+
+class Registry(object):
+    """Hosts clients for many secrets in one process. Every tenant keeps its
+    own queue and batches, while all of them share one pool of flush
+    workers, one transport (and so one HTTP connection pool) and one
+    scheduler thread.
+
+    Tenants with queued actions take turns on the workers one batch at a
+    time, so a noisy tenant can't starve the others.
+
+    """
+
+    def __init__(self, workers=4, transport=None, tick=1.0, **defaults):
+        """
+        :param int workers: The number of threads sending batches for all
+        tenants
+        :param segmentio.transport.Transport transport: Shared by every
+        tenant, defaults to HTTP with a connection per worker
+        :param float tick: Seconds between checks for tenants whose
+        flush_after has passed without a flush
+
+        Other kwargs are Client arguments for every tenant.
+        """
+        self.defaults = defaults
+        self.transport = transport or HTTPTransport(pool_size=workers)
+        self.tick = tick
+
+        self.lock = threading.Lock()
+        self.clients = {}
+
+        # tenants waiting for a worker, each listed at most once
+        self.condition = threading.Condition()
+        self.ready = collections.deque()
+        self.scheduled = set()
+        self.busy = 0
+
+        self.stopped = threading.Event()
+
+        self.threads = [threading.Thread(target=self._work)
+                        for i in range(workers)]
+        self.threads.append(threading.Thread(target=self._schedule_stale))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def client(self, secret, **kwargs):
+        """Returns the client for secret, creating it on first use with the
+        registry's Client arguments updated by kwargs. Each tenant gets its
+        own Statistics unless one is given.
+
+        """
+        with self.lock:
+            client = self.clients.get(secret)
+
+            if client is None:
+                settings = dict(self.defaults, **kwargs)
+                settings.setdefault('stats', Statistics())
+                settings['transport'] = self.transport
+
+                client = TenantClient(self, secret, **settings)
+                self.clients[secret] = client
+
+            return client
+
+    def _schedule(self, client):
+        with self.condition:
+            if client in self.scheduled:
+                return
+
+            self.scheduled.add(client)
+            self.ready.append(client)
+            self.condition.notify()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.ready and not self.stopped.is_set():
+                    self.condition.wait()
+
+                if not self.ready:
+                    return
+
+                client = self.ready.popleft()
+                self.busy += 1
+
+            try:
+                client._flush_batch()
+            except Exception:
+                log('error', 'analytics-python registry flush failed',
+                    exc_info=True)
+            finally:
+                with self.condition:
+                    self.busy -= 1
+
+                    # back of the line if there's more to send
+                    if len(client.queue) > 0:
+                        self.ready.append(client)
+                    else:
+                        self.scheduled.discard(client)
+
+                    self.condition.notify_all()
+
+    def _schedule_stale(self):
+        while not self.stopped.is_set():
+            self.stopped.wait(self.tick)
+
+            now = datetime.now()
+            with self.lock:
+                clients = self.clients.values()
+
+            for client in clients:
+                if len(client.queue) == 0:
+                    continue
+                if client.last_flushed is None or \
+                        now - client.last_flushed > client.flush_after:
+                    client.flush()
+
+    def flush(self, timeout=None):
+        """Flushes every tenant on the shared workers and waits until they
+        are done, or timeout seconds pass
+
+        Returns True if everything queued was sent.
+        """
+        with self.lock:
+            clients = self.clients.values()
+
+        for client in clients:
+            if len(client.queue) > 0:
+                client.flush()
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        with self.condition:
+            while self.ready or self.busy:
+                if deadline is None:
+                    self.condition.wait()
+                    continue
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+
+        return True
+
+    def close(self, timeout=None):
+        """ Flushes every tenant and stops the shared threads """
+        self.flush(timeout)
+
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+
+        for thread in self.threads:
+            thread.join(timeout)
+
+        self.transport.close()
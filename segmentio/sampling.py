@@ -0,0 +1,78 @@
+import threading
+import time
+import zlib
+
+
+class Sampler(object):
+    """Keeps a fixed fraction of each configured event name.
+
+    The decision is a hash of the user_id, so a given user's events are
+    either all kept or all dropped, in every process.
+
+    """
+
+    def __init__(self, rates):
+        """
+        :param dict rates: Maps event names to the fraction of users
+        (0.0 to 1.0) whose events are kept. Other events are always kept.
+        """
+        self.rates = dict(rates)
+
+    def keep(self, event, user_id):
+        rate = self.rates.get(event)
+        if rate is None or rate >= 1:
+            return True
+        if rate <= 0:
+            return False
+
+        if isinstance(user_id, unicode):
+            user_id = user_id.encode('utf-8')
+        bucket = (zlib.crc32(str(user_id)) & 0xffffffff) / 4294967296.0
+
+        return bucket < rate
+
+
+class RateLimiter(object):
+    """Caps the number of events per second for each configured event name,
+    allowing bursts of up to one second's worth, or of one event for limits
+    below one a second.
+
+    """
+
+    def __init__(self, limits):
+        """
+        :param dict limits: Maps event names to the maximum number of events
+        per second, 0 to drop every one. Other events are never limited.
+        """
+        self.limits = dict(limits)
+
+        self.lock = threading.Lock()
+        # event name -> [available tokens, last refill time]
+        self.buckets = {}
+
+    def allow(self, event):
+        limit = self.limits.get(event)
+        if limit is None:
+            return True
+        if limit <= 0:
+            return False
+
+        now = time.time()
+
+        # a bucket smaller than one token would never allow an event
+        capacity = max(limit, 1)
+
+        with self.lock:
+            bucket = self.buckets.get(event)
+            if bucket is None:
+                bucket = self.buckets[event] = [capacity, now]
+
+            tokens = min(capacity, bucket[0] + (now - bucket[1]) * limit)
+            bucket[1] = now
+
+            if tokens < 1:
+                bucket[0] = tokens
+                return False
+
+            bucket[0] = tokens - 1
+            return True
@@ -8,15 +8,58 @@ class Statistics(object):
 
         # The number of identifies submitted
         self.identifies = 0
+        # The number of identifies dropped as duplicates of a recent one
+        self.identifies_suppressed = 0
+        # The number of identifies merged into one queued for the same user
+        self.identifies_coalesced = 0
         # The number of tracks submitted
         self.tracks = 0
         # The number of aliases
         self.aliases = 0
 
+        # The number of tracks dropped by sampling, by event name
+        self.sampled_out = {}
+        # The number of tracks dropped by rate limits, by event name
+        self.rate_limited = {}
+
+        # The number of actions dropped from a full queue
+        self.dropped = 0
+
         # The number of actions to be successful
         self.successful = 0
         # The number of actions to fail
         self.failed = 0
 
+        # The number of extra requests sent bisecting rejected batches
+        self.bisections = 0
+        # The number of actions isolated as rejected by bisection
+        self.dead_letters = 0
+
+        # The approximate encoded bytes queued, with max_queue_bytes set
+        self.queue_bytes = 0
+
         # The number of flushes to happen
         self.flushes = 0
+        # The number of batches being sent right now
+        self.in_flight = 0
+
+        # The batch size last set by the adaptive controller
+        self.adaptive_batch_size = 0
+        # The flush interval in seconds last set by the adaptive controller
+        self.adaptive_flush_interval = 0
+        # The number of requests that grew or shrank the adaptive settings
+        self.adaptive_increases = 0
+        self.adaptive_decreases = 0
+
+        # The number of interned strings found in the intern cache
+        self.intern_hits = 0
+        # The number of interned strings added to the intern cache
+        self.intern_misses = 0
+
+    @property
+    def intern_hit_rate(self):
+        """ The fraction of intern lookups served from the cache """
+        lookups = self.intern_hits + self.intern_misses
+        if lookups == 0:
+            return 0.0
+        return float(self.intern_hits) / lookups
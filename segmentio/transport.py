@@ -0,0 +1,307 @@
+import collections
+import json
+import os
+import threading
+
+from errors import ApiError
+from utils import log
+
+import options
+
+
+def package_exception(client, data, e):
+    log('warn', 'Segment.io request error', exc_info=True)
+    client._on_failed_flush(data, e)
+
+
+def package_response(client, data, response):
+    # TODO: reduce the complexity (mccabe)
+    if response.status_code == 200:
+        client._on_successful_flush(data, response)
+    elif response.status_code == 400:
+        content = response.text
+        try:
+            body = json.loads(content)
+
+            code = 'bad_request'
+            message = 'Bad request'
+
+            error = body.get('error')
+            if isinstance(error, dict):
+                code = error.get('code', code)
+                message = error.get('message', message)
+            elif error:
+                message = error
+
+            error = ApiError(code, message)
+
+        except Exception:
+            error = ApiError('Bad Request', content)
+
+        client._on_rejected_flush(data, error)
+    else:
+        client._on_failed_flush(data,
+                                ApiError(response.status_code, response.text))
+
+
+def gzip_compress(body):
+    import gzip
+    from StringIO import StringIO
+
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb')
+    try:
+        f.write(body)
+    finally:
+        f.close()
+    return buf.getvalue()
+
+
+def request(client, url, data, session=None, compress=False):
+    # imported on first send, it dominates the time to import segmentio
+    import requests
+
+    log('debug', 'Sending request to Segment.io ...')
+    try:
+
+        body = client.serializer.dumps(data)
+        headers = {'content-type': 'application/json'}
+        if compress:
+            body = gzip_compress(body)
+            headers['content-encoding'] = 'gzip'
+
+        response = (session or requests).post(
+            url,
+            data=body,
+            headers=headers,
+            timeout=client.timeout)
+
+        log('debug', 'Finished Segment.io request.')
+
+        package_response(client, data, response)
+
+        return response.status_code == 200
+
+    except requests.ConnectionError as e:
+        package_exception(client, data, e)
+    except requests.Timeout as e:
+        package_exception(client, data, e)
+
+    return False
+
+
+class Transport(object):
+    """Delivers batches for a Client. Subclasses implement send."""
+
+    def send(self, client, data):
+        """Delivers data, a dict of a 'batch' list of actions and the
+        'secret', and reports the outcome through client._on_successful_flush
+        or client._on_failed_flush
+
+        Returns True if the batch was delivered.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """ Flushes and releases anything held by the transport """
+        pass
+
+
+class HTTPTransport(Transport):
+    """Posts batches to the Segment.io API, reusing connections across
+    requests.
+
+    """
+
+    def __init__(self, session=None, pool_size=None, compress=False):
+        """
+        :param requests.Session session: The session to post through,
+        created on first send if None
+        :param int pool_size: The number of connections the created session
+        keeps open, at least the number of threads sending through it
+        :param bool compress: True to gzip request bodies, which pays off
+        for large batches
+        """
+        self.session = session
+        self.pool_size = pool_size
+        self.compress = compress
+        self.lock = threading.Lock()
+
+    def _create_session(self):
+        import requests
+
+        session = requests.Session()
+        if self.pool_size is not None:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        return session
+
+    def send(self, client, data):
+        if self.session is None:
+            with self.lock:
+                if self.session is None:
+                    self.session = self._create_session()
+
+        url = options.host + options.endpoints['batch']
+        return request(client, url, data, self.session, self.compress)
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+
+class StdlibResponse(object):
+    """ The parts of a requests.Response that package_response reads """
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+
+class StdlibHTTPTransport(Transport):
+    """Posts batches with the standard library's httplib over a new
+    connection each time. It skips importing requests, which makes it the
+    faster choice for processes that send a single batch and exit.
+
+    """
+
+    def send(self, client, data):
+        import httplib
+        import socket
+        import urlparse
+
+        url = urlparse.urlsplit(options.host)
+        if url.scheme == 'https':
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+
+        log('debug', 'Sending request to Segment.io ...')
+        try:
+            connection = connection_class(url.netloc, timeout=client.timeout)
+            try:
+                connection.request('POST',
+                                   url.path.rstrip('/') +
+                                   options.endpoints['batch'],
+                                   client.serializer.dumps(data),
+                                   {'content-type': 'application/json'})
+                raw = connection.getresponse()
+                response = StdlibResponse(raw.status, raw.read())
+            finally:
+                connection.close()
+
+        except (httplib.HTTPException, socket.error) as e:
+            package_exception(client, data, e)
+            return False
+
+        log('debug', 'Finished Segment.io request.')
+
+        package_response(client, data, response)
+
+        return response.status_code == 200
+
+
+class FileTransport(Transport):
+    """Appends each action as a line of JSON to a local file, to be uploaded
+    later. Lines are objects of 'secret' and 'action', so a file shared by
+    clients with different secrets can be split up again. Once the file grows
+    past max_bytes it is renamed to the next free path.N (path.1, path.2, ...)
+    and a new file is started, so finished segments can be picked up in order.
+
+    Lines are buffered in memory, call close() before exiting to write them
+    out.
+
+    """
+
+    def __init__(self, path, max_bytes=100 * 1024 * 1024,
+                 buffer_size=1024 * 1024):
+        """
+        :param str path: The file actions are appended to
+        :param int max_bytes: The size at which the file is rotated
+        :param int buffer_size: Bytes buffered in memory between writes
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.buffer_size = buffer_size
+
+        self.lock = threading.Lock()
+        self.file = None
+        self.size = 0
+
+    def _open(self):
+        self.file = open(self.path, 'ab', self.buffer_size)
+        self.size = os.fstat(self.file.fileno()).st_size
+
+    def _next_segment(self):
+        index = 1
+        while os.path.exists('%s.%d' % (self.path, index)):
+            index += 1
+        return '%s.%d' % (self.path, index)
+
+    def rotate(self):
+        """ Closes the current file and moves it to the next segment path """
+        with self.lock:
+            self._rotate()
+
+    def _rotate(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            os.rename(self.path, self._next_segment())
+
+    def send(self, client, data):
+        dumps = client.serializer.dumps
+        secret = data['secret']
+        lines = ''.join(dumps({'secret': secret, 'action': action}) + '\n'
+                        for action in data['batch'])
+
+        try:
+            with self.lock:
+                if self.file is None:
+                    self._open()
+
+                self.file.write(lines)
+                self.size += len(lines)
+
+                if self.size >= self.max_bytes:
+                    self._rotate()
+
+        except (IOError, OSError) as e:
+            log('warn', 'analytics-python file transport error',
+                exc_info=True)
+            client._on_failed_flush(data, e)
+            return False
+
+        client._on_successful_flush(data, None)
+        return True
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class MemoryTransport(Transport):
+    """Keeps delivered actions in memory, for tests and load tests that
+    shouldn't touch the network.
+
+    """
+
+    def __init__(self, max_size=None):
+        """
+        :param int max_size: The number of most recent actions kept, None to
+        keep every action
+        """
+        self.actions = collections.deque(maxlen=max_size)
+        self.batches = 0
+
+    def send(self, client, data):
+        self.actions.extend(data['batch'])
+        self.batches += 1
+        client._on_successful_flush(data, None)
+        return True
@@ -1,6 +1,45 @@
 import json
-from datetime import datetime
-from dateutil.tz import tzlocal, tzutc
+import logging
+import numbers
+import sys
+from datetime import date, datetime, timedelta, tzinfo
+
+
+logging_enabled = True
+logger = logging.getLogger('analytics')
+
+
+def log(level, *args, **kwargs):
+    if logging_enabled:
+        method = getattr(logger, level)
+        method(*args, **kwargs)
+
+
+class UTC(tzinfo):
+    """UTC, so stamping the current time doesn't need to import dateutil
+
+    """
+
+    def utcoffset(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        return 'UTC'
+
+    def dst(self, dt):
+        return timedelta(0)
+
+    def __repr__(self):
+        return 'UTC()'
+
+utc = UTC()
+
+
+def is_decimal(obj):
+    """ Determines if obj is a decimal.Decimal, without importing decimal """
+    # no Decimal can exist unless something else imported the module
+    decimal = sys.modules.get('decimal')
+    return decimal is not None and isinstance(obj, decimal.Decimal)
 
 
 def is_naive(dt):
@@ -12,6 +51,24 @@ def total_seconds(delta):
     # http://stackoverflow.com/questions/3694835/python-2-6-5-divide-timedelta-with-timedelta
     return (delta.microseconds + (delta.seconds + delta.days * 24 * 3600) * 1e6) / 1e6
 
+def approximate_size(obj):
+    """Estimates the bytes obj takes encoded as JSON, without encoding it"""
+    if isinstance(obj, basestring):
+        return len(obj) + 2
+    elif isinstance(obj, dict):
+        return 2 + sum(approximate_size(k) + approximate_size(v) + 2
+                       for k, v in obj.iteritems())
+    elif isinstance(obj, (set, list, tuple)):
+        return 2 + sum(approximate_size(item) + 1 for item in obj)
+    elif obj is None or isinstance(obj, bool):
+        return 5
+    elif isinstance(obj, (datetime, date)):
+        return 34
+    elif isinstance(obj, numbers.Number):
+        return len(str(obj))
+    # other values are coerced to strings when cleaned, guess their length
+    return 16
+
 def guess_timezone(dt):
     """ Attempts to convert a naive datetime to an aware datetime """
     if is_naive(dt):
@@ -22,16 +79,251 @@ def guess_timezone(dt):
         if total_seconds(delta) < 5:
             # this was created using datetime.datetime.now()
             # so we are in the local timezone
+            from dateutil.tz import tzlocal
             return dt.replace(tzinfo=tzlocal())
         else:
             # at this point, the best we can do (I htink) is guess UTC
-            return dt.replace(tzinfo=tzutc())
+            return dt.replace(tzinfo=utc)
 
     return dt
 
 class DatetimeSerializer(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, datetime):
+        if isinstance(obj, (datetime, date)):
             return obj.isoformat()
 
+        if is_decimal(obj):
+            return float(obj)
+
         return json.JSONEncoder.default(self, obj)
+
+
+class JSONSerializer(object):
+    """ Encodes batches with the standard library json module """
+
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj, cls=DatetimeSerializer, separators=(',', ':'))
+
+
+class SimpleJSONSerializer(object):
+    """ Encodes batches with simplejson's C speedups """
+
+    name = 'simplejson'
+
+    def __init__(self):
+        import simplejson
+        self.simplejson = simplejson
+        self.encoder = simplejson.JSONEncoder(
+            separators=(',', ':'), use_decimal=True,
+            default=DatetimeSerializer().default)
+
+    def dumps(self, obj):
+        return self.encoder.encode(obj)
+
+
+class UltraJSONSerializer(object):
+    """Encodes batches with ujson, falling back to the standard library
+    for batches holding values ujson can't encode, like datetimes outside
+    of cleaned properties and traits.
+
+    """
+
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self.ujson = ujson
+        self.fallback = JSONSerializer()
+
+    def dumps(self, obj):
+        try:
+            return self.ujson.dumps(obj)
+        except (TypeError, OverflowError):
+            return self.fallback.dumps(obj)
+
+
+serializers = [JSONSerializer, SimpleJSONSerializer, UltraJSONSerializer]
+
+# tried in order when no serializer is given, fastest first as measured by
+# benchmarks/serialization.py. simplejson is left out, it is no faster than
+# the standard library's C encoder
+preferred_serializers = [UltraJSONSerializer, JSONSerializer]
+
+
+class AutoSerializer(object):
+    """Encodes batches with the first installed of preferred_serializers,
+    picked on first use so importing segmentio doesn't import them.
+
+    """
+
+    name = 'auto'
+
+    def __init__(self):
+        self.backend = None
+
+    def dumps(self, obj):
+        if self.backend is None:
+            for serializer in preferred_serializers:
+                try:
+                    self.backend = serializer()
+                    break
+                except ImportError:
+                    pass
+
+        return self.backend.dumps(obj)
+
+default_serializer = AutoSerializer()
+
+
+_missing = object()
+
+
+def _shared_context(batch):
+    """ The context items every action of batch has, None if there are none """
+    if not batch or len(batch) < 2:
+        return None
+
+    shared = None
+    previous = None
+    for action in batch:
+        context = action.get('context')
+        if not isinstance(context, dict):
+            return None
+
+        # actions often share the caller's context dict
+        if context is previous:
+            continue
+        previous = context
+
+        if shared is None:
+            shared = dict(context)
+            continue
+
+        for key, value in shared.items():
+            other = context.get(key, _missing)
+            if other is not value and other != value:
+                del shared[key]
+
+        if not shared:
+            return None
+
+    return shared or None
+
+
+def _context_remainder(context, shared):
+    """ The items of context not in shared, None if there are none """
+    # every context holds all of shared
+    if len(context) == len(shared):
+        return None
+
+    rest = dict(context)
+    for key in shared:
+        del rest[key]
+    return rest
+
+
+def hoist_context(payload):
+    """Returns payload with the context items shared by every action of its
+    batch moved to a batch level context, which the API merges back into
+    each action's context. The actions themselves are copied, not changed.
+
+    """
+    batch = payload.get('batch')
+    shared = _shared_context(batch)
+    if shared is None:
+        return payload
+
+    actions = []
+    previous = rest = None
+    for action in batch:
+        context = action['context']
+        if context is not previous:
+            previous = context
+            rest = _context_remainder(context, shared)
+
+        action = dict(action)
+        if rest:
+            action['context'] = rest
+        else:
+            del action['context']
+        actions.append(action)
+
+    return dict(payload, batch=actions, context=shared)
+
+
+def merge_context(payload):
+    """ The actions of a batch with its batch level context merged back in """
+    shared = payload.get('context')
+    if shared is None:
+        return payload['batch']
+
+    actions = []
+    for action in payload['batch']:
+        context = dict(shared)
+        context.update(action.get('context') or {})
+        actions.append(dict(action, context=context))
+    return actions
+
+
+class ContextHoistingSerializer(object):
+    """Wraps a serializer to send the contexts of a batch's actions once.
+
+    Rather than copying every action like hoist_context, it swaps each
+    action's context for what is left of it while encoding, and puts the
+    original back afterwards, so the batch must not be read by another
+    thread meanwhile.
+
+    """
+
+    def __init__(self, serializer):
+        self.serializer = serializer
+        self.name = getattr(serializer, 'name', None)
+
+    def dumps(self, obj):
+        if not isinstance(obj, dict) or 'batch' not in obj:
+            return self.serializer.dumps(obj)
+
+        batch = obj['batch']
+        shared = _shared_context(batch)
+        if shared is None:
+            return self.serializer.dumps(obj)
+
+        contexts = []
+        previous = rest = None
+        try:
+            for action in batch:
+                context = action['context']
+                contexts.append(context)
+                if context is not previous:
+                    previous = context
+                    rest = _context_remainder(context, shared)
+
+                if rest:
+                    action['context'] = rest
+                else:
+                    del action['context']
+            return self.serializer.dumps(dict(obj, context=shared))
+        finally:
+            for action, context in zip(batch, contexts):
+                action['context'] = context
+
+
+def get_serializer(serializer=None):
+    """Returns a serializer for the given backend name ('json',
+    'simplejson' or 'ujson'), the preferred installed backend if None, or
+    the given object itself if it already has a dumps method.
+
+    """
+    if serializer is None:
+        return default_serializer
+
+    if hasattr(serializer, 'dumps'):
+        return serializer
+
+    for cls in serializers:
+        if cls.name == serializer:
+            return cls()
+
+    raise Exception('Unknown serializer "%s".' % serializer)
@@ -3,6 +3,13 @@
 
 import unittest
 import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
 
 from datetime import datetime, timedelta
 
@@ -17,6 +24,20 @@ from dateutil.tz import tzutc
 
 import analytics
 import analytics.utils
+from analytics.cache import LRUCache, StringInterner
+from analytics.deadletter import FileDeadLetterStore, \
+    MemoryDeadLetterStore, Replayer
+from analytics.client import Client
+from analytics.adaptive import AdaptiveController
+from analytics.exporters import PrometheusExporter, StatsdExporter
+from analytics.lanes import LaneQueue
+from analytics.registry import Registry
+from analytics.profiling import AggregateSink, CallbackSink, Profiler
+from analytics.transport import FileTransport, MemoryTransport, \
+    StdlibResponse, gzip_compress, package_response
+from analytics.stats import Statistics
+from analytics.utils import hoist_context, merge_context, \
+    ContextHoistingSerializer, JSONSerializer
 
 secret = 'testsecret'
 
@@ -304,5 +325,1097 @@ class AnalyticsBasicTests(unittest.TestCase):
             analytics.flush()
             sleep(1.0)
 
+
+def queueing_client(**kwargs):
+    """ Creates a client that holds actions in its queue until flushed """
+    kwargs.setdefault('stats', Statistics())
+    client = Client(secret, flush_at=1000, flush_after=timedelta(days=1),
+                    **kwargs)
+    client.last_flushed = datetime.now()
+    return client
+
+
+class AnalyticsCacheTests(unittest.TestCase):
+
+    def test_lru_eviction(self):
+
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+
+        # touching 'a' makes 'b' the least recently used
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.pop('c'), 3)
+
+    def test_interning(self):
+
+        stats = Statistics()
+        client = queueing_client(stats=stats, intern_strings=True)
+
+        # build equal strings that aren't the same object
+        event = ''.join(['Played ', 'a Song'])
+        client.track('ilya@analytics.io', event, {''.join(['Art', 'ist']): 1})
+        client.track('ilya@analytics.io', 'Played a Song', {'Artist': 2})
+
+        first, second = client.queue
+        self.assertTrue(first['event'] is second['event'])
+        self.assertTrue(first['properties'].keys()[0] is
+                        second['properties'].keys()[0])
+
+        self.assertEqual(stats.intern_hits, 2)
+        self.assertEqual(stats.intern_misses, 2)
+        self.assertEqual(stats.intern_hit_rate, 0.5)
+
+    def test_interner_is_bounded(self):
+
+        interner = StringInterner(max_size=2)
+        c = u''.join([u'c', u'd'])
+        for s in [u'ab', u'bc', c]:
+            interner.intern(s)
+
+        # full, it started over with the latest
+        self.assertEqual(len(interner), 1)
+        self.assertTrue(interner.intern(u''.join([u'c', u'd'])) is c)
+
+    def test_identify_deduplication(self):
+
+        stats = Statistics()
+        client = queueing_client(stats=stats,
+                                 identify_dedup_window=timedelta(seconds=1))
+
+        traits = {'Subscription Plan': 'Free', 'Friends': 30}
+
+        client.identify('ilya@analytics.io', traits)
+        client.identify('ilya@analytics.io', dict(traits))
+        client.identify('ilya@analytics.io', {'Friends': 31})
+        client.identify('peter@analytics.io', traits)
+
+        self.assertEqual(len(client.queue), 3)
+        self.assertEqual(stats.identifies_suppressed, 1)
+
+        # past the window the same traits are sent again
+        sleep(1.1)
+        client.identify('ilya@analytics.io', traits)
+
+        self.assertEqual(len(client.queue), 4)
+        self.assertEqual(stats.identifies, 4)
+
+    def test_deduplication_only_counts_queued(self):
+
+        stats = Statistics()
+        client = queueing_client(stats=stats, max_queue_size=0,
+                                 identify_dedup_window=timedelta(hours=1))
+
+        client.identify('ilya@analytics.io', {'Plan': 'pro'})
+        client.max_queue_size = 10
+        client.identify('ilya@analytics.io', {'Plan': 'pro'})
+
+        # the first was dropped, so the second is no duplicate
+        self.assertEqual(stats.identifies_suppressed, 0)
+        self.assertEqual(len(client.queue), 1)
+
+
+class AnalyticsSamplingTests(unittest.TestCase):
+
+    def test_sampling_is_consistent_per_user(self):
+
+        stats = Statistics()
+        client = queueing_client(stats=stats, sample_rates={'Heartbeat': 0.5})
+
+        users = ['user%d' % i for i in range(200)]
+        for user in users:
+            client.track(user, 'Heartbeat')
+            client.track(user, 'Heartbeat')
+            client.track(user, 'Signed Up')
+
+        kept = set(action['userId'] for action in client.queue
+                   if action['event'] == 'Heartbeat')
+
+        self.assertTrue(50 < len(kept) < 150)
+        self.assertEqual(stats.sampled_out['Heartbeat'],
+                         2 * (len(users) - len(kept)))
+        self.assertFalse('Signed Up' in stats.sampled_out)
+        self.assertEqual(stats.tracks, 2 * len(kept) + len(users))
+
+    def test_rate_limits(self):
+
+        stats = Statistics()
+        client = queueing_client(stats=stats, rate_limits={'Scrolled': 10})
+
+        for i in range(25):
+            client.track('ilya@analytics.io', 'Scrolled')
+            client.track('ilya@analytics.io', 'Played a Song')
+
+        self.assertEqual(stats.tracks, 35)
+        self.assertEqual(stats.rate_limited, {'Scrolled': 15})
+
+    def test_rate_limits_below_one_per_second(self):
+
+        stats = Statistics()
+        client = queueing_client(stats=stats, rate_limits={'Scrolled': 0.5})
+
+        client.track('ilya@analytics.io', 'Scrolled')
+        client.track('ilya@analytics.io', 'Scrolled')
+        self.assertEqual(stats.tracks, 1)
+
+        # pretend two seconds went by
+        client.rate_limiter.buckets['Scrolled'][1] -= 2
+        client.track('ilya@analytics.io', 'Scrolled')
+        self.assertEqual(stats.tracks, 2)
+
+    def test_invalid_calls_raise_before_dropping(self):
+
+        client = queueing_client(sample_rates={'Heartbeat': 0},
+                                 rate_limits={'Scrolled': 0.5})
+        self.assertRaises(Exception, client.track, 'ilya@analytics.io',
+                          'Heartbeat', properties='not a dict')
+        self.assertRaises(Exception, client.track, 'ilya@analytics.io',
+                          'Scrolled', context='not a dict')
+        self.assertRaises(Exception, client.track, 'ilya@analytics.io',
+                          'Heartbeat', timestamp='yesterday')
+
+
+class AnalyticsLaneTests(unittest.TestCase):
+
+    def test_weighted_fifo_draining(self):
+
+        queue = LaneQueue({'critical': {'weight': 3}})
+
+        for i in range(8):
+            queue.append(('default', i))
+            queue.append(('critical', i), 'critical')
+
+        drained = [queue.popleft() for i in range(8)]
+
+        self.assertEqual([a for a in drained if a[0] == 'critical'],
+                         [('critical', i) for i in range(6)])
+        self.assertEqual([a for a in drained if a[0] == 'default'],
+                         [('default', 0), ('default', 1)])
+
+        # once the critical lane is empty the rest drains in order
+        rest = [queue.popleft() for i in range(len(queue))]
+        self.assertEqual(rest[-6:], [('default', i) for i in range(2, 8)])
+        self.assertRaises(IndexError, queue.popleft)
+
+    def test_lane_overflow(self):
+
+        stats = Statistics()
+        client = queueing_client(stats=stats, lanes={
+            'low': {'capacity': 2, 'overflow': 'drop_oldest'},
+            'default': {'capacity': 1}
+        })
+
+        for song in ['One', 'Two', 'Three']:
+            client.track('ilya@analytics.io', 'Played a Song',
+                         {'Song': song}, lane='low')
+            client.track('ilya@analytics.io', 'Played a Song', {'Song': song})
+
+        songs = [action['properties']['Song'] for action in client.queue]
+        self.assertEqual(sorted(songs), ['One', 'Three', 'Two'])
+        self.assertEqual(stats.dropped, 3)
+
+        self.assertRaises(Exception, client.track, 'ilya@analytics.io',
+                          'Played a Song', lane='missing')
+
+    def test_saturated_queue_keeps_critical_actions(self):
+
+        stats = Statistics()
+        client = queueing_client(stats=stats, max_queue_size=10,
+                                 lanes={'critical': {'weight': 4}})
+
+        for i in range(10):
+            client.track('ilya@analytics.io', 'Played a Song', {'i': i})
+        client.track('ilya@analytics.io', 'Bought a Song', lane='critical')
+
+        # the oldest default action made room
+        self.assertEqual(len(client.queue), 10)
+        self.assertEqual(len(client.queue.lane('critical').actions), 1)
+        self.assertEqual([a['properties']['i']
+                          for a in client.queue.lane('default').actions],
+                         range(1, 10))
+        self.assertEqual(stats.dropped, 1)
+
+        # a default action has no lighter lane to evict from
+        client.track('ilya@analytics.io', 'Played a Song', {'i': 10})
+        self.assertEqual(len(client.queue), 10)
+        self.assertEqual(stats.dropped, 2)
+
+
+class AnalyticsSerializerTests(unittest.TestCase):
+
+    def test_serializers_agree(self):
+
+        client = queueing_client()
+        client.track('ilya@analytics.io', 'Bought a Song', {
+            'price': Decimal('1.29'),
+            'released': datetime(1966, 8, 5, 10, 30),
+            'tags': ('rock', 'pop')
+        })
+
+        payload = {'batch': list(client.queue), 'secret': secret}
+        properties = payload['batch'][0]['properties']
+
+        # cleaning leaves only JSON native values
+        self.assertEqual(properties['price'], 1.29)
+        self.assertEqual(properties['released'], '1966-08-05T10:30:00')
+
+        expected = json.loads(json.dumps(payload))
+
+        for cls in analytics.utils.serializers:
+            try:
+                serializer = analytics.utils.get_serializer(cls.name)
+            except ImportError:
+                continue
+            self.assertEqual(json.loads(serializer.dumps(payload)), expected)
+
+        # values that skipped cleaning still encode
+        dumps = analytics.utils.get_serializer('json').dumps
+        self.assertEqual(dumps({'at': Decimal('0.5')}), '{"at":0.5}')
+
+        self.assertRaises(Exception, analytics.utils.get_serializer, 'xml')
+
+
+class AnalyticsTransportTests(unittest.TestCase):
+
+    def test_memory_transport(self):
+
+        stats = Statistics()
+        transport = MemoryTransport()
+        client = queueing_client(stats=stats, transport=transport)
+
+        for i in range(120):
+            client.track('ilya@analytics.io', 'Played a Song', {'i': i})
+
+        client.flush(async=False)
+
+        self.assertEqual(transport.batches, 3)
+        self.assertEqual([a['properties']['i'] for a in transport.actions],
+                         range(120))
+        self.assertEqual(stats.successful, 120)
+
+    def test_file_transport_rotation(self):
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'events.jsonl')
+
+        transport = FileTransport(path, max_bytes=1000)
+        client = queueing_client(transport=transport)
+
+        for i in range(100):
+            client.track('ilya@analytics.io', 'Played a Song', {'i': i})
+
+        client.flush(async=False)
+        transport.close()
+
+        segments = sorted(os.listdir(directory))
+        self.assertTrue(len(segments) > 1)
+        self.assertTrue('events.jsonl.1' in segments)
+
+        lines = []
+        paths = ['%s.%d' % (path, i) for i in range(1, len(segments) + 1)]
+        for segment in paths + [path]:
+            if os.path.exists(segment):
+                with open(segment) as f:
+                    lines.extend(f.readlines())
+
+        lines = [json.loads(l) for l in lines]
+        self.assertEqual([l['action']['properties']['i'] for l in lines],
+                         range(100))
+        self.assertEqual(set(l['secret'] for l in lines), set([secret]))
+
+
+class AnalyticsColdStartTests(unittest.TestCase):
+
+    # seconds allowed for importing analytics.client in a fresh interpreter
+    import_budget = 0.075
+
+    def test_import_budget(self):
+
+        script = ('import sys, time; start = time.time(); '
+                  'import analytics.client; '
+                  'print time.time() - start; '
+                  'print " ".join(sorted(sys.modules))')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+
+        durations = []
+        for i in range(3):
+            output = subprocess.Popen([sys.executable, '-c', script],
+                                      stdout=subprocess.PIPE,
+                                      env=env).communicate()[0]
+            duration, modules = output.splitlines()
+            durations.append(float(duration))
+
+        modules = modules.split()
+        for heavy in ['requests', 'dateutil', 'decimal', 'simplejson']:
+            self.assertFalse(heavy in modules, heavy + ' imported eagerly')
+
+        self.assertTrue(min(durations) < self.import_budget,
+                        'importing took %.3fs' % min(durations))
+
+    def test_fire_once(self):
+
+        previous_host = analytics.options.host
+        analytics.options.host = 'http://127.0.0.1:1'
+        self.addCleanup(setattr, analytics.options, 'host', previous_host)
+
+        self.assertFalse(analytics.fire_once(secret, 'track',
+                                             user_id='ilya@analytics.io',
+                                             event='Ran Report'))
+        self.assertRaises(Exception, analytics.fire_once, secret, 'page')
+
+
+class FlakyTransport(MemoryTransport):
+    """ A MemoryTransport that fails batches while failing is set """
+
+    failing = False
+
+    def send(self, client, data):
+        if self.failing:
+            client._on_failed_flush(data, Exception('Flaky'))
+            return False
+        return MemoryTransport.send(self, client, data)
+
+
+class AnalyticsAdaptiveTests(unittest.TestCase):
+
+    def test_aimd(self):
+
+        stats = Statistics()
+        transport = FlakyTransport()
+        controller = AdaptiveController(
+            min_batch=10, max_batch=100, batch_step=10,
+            min_interval=timedelta(seconds=1),
+            max_interval=timedelta(seconds=8),
+            interval_step=timedelta(seconds=1))
+        client = queueing_client(stats=stats, transport=transport,
+                                 adaptive=controller, async=False)
+
+        # the day long flush_after is clamped into the bounds
+        self.assertEqual(client.flush_after, timedelta(seconds=8))
+        self.assertEqual(client.flush_at, 50)
+
+        for i in range(120):
+            client.track('ilya@analytics.io', 'Played a Song')
+        client.flush(async=False)
+
+        # flushes of 50, 60 and the last 10: full batches grew the batch
+        # size and every healthy request brought the interval down
+        self.assertEqual(transport.batches, 3)
+        self.assertEqual(client.max_flush_size, 70)
+        self.assertEqual(client.flush_at, 70)
+        self.assertEqual(stats.adaptive_batch_size, 70)
+        self.assertEqual(stats.adaptive_flush_interval, 5)
+        self.assertEqual(stats.adaptive_increases, 3)
+
+        transport.failing = True
+        for i in range(5):
+            client.track('ilya@analytics.io', 'Played a Song')
+        client.flush(async=False)
+
+        self.assertEqual(client.max_flush_size, 35)
+        self.assertEqual(client.flush_after, timedelta(seconds=8))
+        self.assertEqual(stats.adaptive_decreases, 1)
+
+    def test_long_drain_is_no_backlog(self):
+
+        controller = AdaptiveController(
+            min_batch=10, max_batch=10,
+            min_interval=timedelta(seconds=1),
+            max_interval=timedelta(seconds=8),
+            interval_step=timedelta(seconds=1))
+        client = queueing_client(transport=MemoryTransport(),
+                                 adaptive=controller)
+        client.flush_at = 1000
+
+        for i in range(50):
+            client.track('ilya@analytics.io', 'Played a Song')
+        client.flush(async=False)
+
+        # five healthy batches, each only shortening by the step
+        self.assertEqual(client.flush_after, timedelta(seconds=3))
+
+
+class AnalyticsProfilingTests(unittest.TestCase):
+
+    def test_stage_timings(self):
+
+        aggregate = AggregateSink()
+        traces = []
+        profiler = Profiler([aggregate, CallbackSink(
+            on_trace=lambda action, laps: traces.append((action, laps)))],
+            trace_rate=1.0)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        transport = FileTransport(os.path.join(directory, 'events.jsonl'))
+        self.addCleanup(transport.close)
+
+        client = queueing_client(profiler=profiler, transport=transport)
+
+        client.identify('ilya@analytics.io', {'Friends': 30})
+        client.track('ilya@analytics.io', 'Played a Song', {'Song': 'Help!'})
+        client.flush(async=False)
+
+        timings = aggregate.snapshot()
+        for stage in ['validate', 'timestamp', 'clean', 'enqueue']:
+            self.assertEqual(timings[stage]['count'], 2)
+        # the file transport encodes each action on its own line
+        self.assertEqual(timings['encode']['count'], 2)
+        self.assertEqual(timings['send']['count'], 1)
+        self.assertTrue(timings['send']['total'] >= 0)
+
+        self.assertEqual([action for action, laps in traces],
+                         ['identify', 'track'])
+        self.assertEqual([stage for stage, seconds in traces[1][1]],
+                         ['validate', 'timestamp', 'clean', 'enqueue'])
+        self.assertEqual(len(aggregate.traces), 2)
+
+
+class AnalyticsExporterTests(unittest.TestCase):
+
+    def test_statsd_export(self):
+
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(2)
+        self.addCleanup(receiver.close)
+
+        stats = Statistics()
+        client = queueing_client(stats=stats, sample_rates={'Heartbeat': 0})
+        client.track('ilya@analytics.io', 'Played a Song')
+        client.track('ilya@analytics.io', 'Heartbeat')
+
+        exporter = StatsdExporter(stats, client,
+                                  port=receiver.getsockname()[1])
+        exporter.export()
+        lines = receiver.recv(4096).split('\n')
+
+        self.assertTrue('segmentio.tracks:1|c' in lines)
+        self.assertTrue('segmentio.sampled_out.Heartbeat:1|c' in lines)
+        self.assertTrue('segmentio.queue_depth:1|g' in lines)
+        self.assertTrue('segmentio.in_flight:0|g' in lines)
+
+        # counters are pushed as deltas, unchanged ones are skipped
+        client.track('ilya@analytics.io', 'Played a Song')
+        exporter.export()
+        lines = receiver.recv(4096).split('\n')
+
+        self.assertTrue('segmentio.tracks:1|c' in lines)
+        self.assertFalse('segmentio.sampled_out.Heartbeat:1|c' in lines)
+
+        # packets are split to fit the size limit
+        exporter.max_packet_size = 64
+        packets = list(exporter.packets(['x' * 30] * 4))
+        self.assertEqual(len(packets), 2)
+
+        # stopping one that never started still pushes a last time
+        exporter.max_packet_size = 1432
+        client.track('ilya@analytics.io', 'Played a Song')
+        exporter.stop()
+        lines = receiver.recv(4096).split('\n')
+        self.assertTrue('segmentio.tracks:1|c' in lines)
+
+    def test_prometheus_export(self):
+
+        stats = Statistics()
+        client = queueing_client(stats=stats,
+                                 rate_limits={'Scrolled "down"': 0})
+        client.track('ilya@analytics.io', 'Scrolled "down"')
+
+        exporter = PrometheusExporter(stats, client, port=0).start()
+        self.addCleanup(exporter.stop)
+
+        import urllib2
+        body = urllib2.urlopen('http://127.0.0.1:%d/metrics'
+                               % exporter.port).read()
+        lines = body.splitlines()
+
+        self.assertTrue('# TYPE segmentio_in_flight gauge' in lines)
+        self.assertTrue('segmentio_queue_depth 0' in lines)
+        self.assertTrue('# TYPE segmentio_rate_limited counter' in lines)
+        self.assertTrue('segmentio_rate_limited{event="Scrolled \\"down\\""} 1'
+                        in lines)
+
+
+class RecordingTransport(MemoryTransport):
+    """ A MemoryTransport that remembers which secret sent each batch """
+
+    def __init__(self):
+        MemoryTransport.__init__(self)
+        self.secrets = []
+
+    def send(self, client, data):
+        self.secrets.append(data['secret'])
+        return MemoryTransport.send(self, client, data)
+
+
+class AnalyticsRegistryTests(unittest.TestCase):
+
+    def test_tenants_share_workers(self):
+
+        transport = RecordingTransport()
+        registry = Registry(workers=1, transport=transport, flush_at=1000,
+                            flush_after=timedelta(days=1))
+        self.addCleanup(registry.close)
+
+        noisy = registry.client('noisy')
+        quiet = registry.client('quiet')
+        self.assertTrue(registry.client('noisy') is noisy)
+
+        # hold the tenants back until both have queued actions
+        noisy.last_flushed = quiet.last_flushed = datetime.now()
+        for i in range(500):
+            noisy.track('ilya@analytics.io', 'Played a Song')
+        for i in range(50):
+            quiet.track('peter@analytics.io', 'Played a Song')
+
+        self.assertTrue(registry.flush(timeout=10))
+
+        self.assertEqual(noisy.stats.successful, 500)
+        self.assertEqual(quiet.stats.successful, 50)
+        self.assertEqual(len(transport.actions), 550)
+
+        # the quiet tenant got the second turn, not the eleventh
+        self.assertEqual(transport.secrets.count('noisy'), 10)
+        self.assertTrue(transport.secrets.index('quiet') <= 1)
+
+    def test_stale_tenants_are_flushed(self):
+
+        transport = MemoryTransport()
+        registry = Registry(workers=2, transport=transport, tick=0.05,
+                            flush_at=1000,
+                            flush_after=timedelta(seconds=0.1))
+        self.addCleanup(registry.close)
+
+        client = registry.client('tenant')
+        client.last_flushed = datetime.now()
+        client.track('ilya@analytics.io', 'Played a Song')
+
+        sleep(0.5)
+        self.assertEqual(client.stats.successful, 1)
+
+
+class RejectingTransport(MemoryTransport):
+    """ A MemoryTransport answering 400 to batches holding a 'Poison' event """
+
+    def send(self, client, data):
+        self.batches += 1
+        if any(action.get('event') == 'Poison' for action in data['batch']):
+            body = json.dumps({'error': {'code': 'invalid',
+                                         'message': 'Bad event'}})
+            package_response(client, data, StdlibResponse(400, body))
+            return False
+
+        self.actions.extend(data['batch'])
+        client._on_successful_flush(data, None)
+        return True
+
+
+class AnalyticsBisectionTests(unittest.TestCase):
+
+    def test_bisects_rejected_batch(self):
+
+        stats = Statistics()
+        transport = RejectingTransport()
+        client = queueing_client(stats=stats, transport=transport,
+                                 async=False)
+
+        dead = []
+        client.on_dead_letter(
+            lambda action, error, attempts: dead.append(
+                (action['properties']['i'], error.code, attempts)))
+
+        for i in range(8):
+            event = 'Poison' if i == 5 else 'Played a Song'
+            client.track('ilya@analytics.io', event, {'i': i})
+        client.flush(async=False)
+
+        # 8 -> 4 + 4 -> 2 + 2 -> 1 + 1
+        self.assertEqual(stats.bisections, 6)
+        self.assertEqual(transport.batches, 7)
+        self.assertEqual(dead, [(5, 'invalid', 4)])
+        self.assertEqual(stats.dead_letters, 1)
+        self.assertEqual(stats.successful, 7)
+        self.assertEqual(stats.failed, 1)
+
+    def test_bisection_reports_delivered(self):
+
+        controller = AdaptiveController(min_batch=10, max_batch=100)
+        client = queueing_client(transport=RejectingTransport(),
+                                 adaptive=controller, async=False)
+        # the controller set flush_at to the batch size, queue a full one
+        client.flush_at = 1000
+
+        for i in range(50):
+            event = 'Poison' if i == 7 else 'Played a Song'
+            client.track('ilya@analytics.io', event)
+
+        self.assertEqual(client._flush_batch(), (49, 1))
+        # rejections are not the server struggling
+        self.assertTrue(client.max_flush_size >= 50)
+
+    def test_bisects_both_rejected_halves(self):
+
+        stats = Statistics()
+        transport = RejectingTransport()
+        client = queueing_client(stats=stats, transport=transport,
+                                 async=False)
+
+        dead = []
+        client.on_dead_letter(
+            lambda action, error, attempts: dead.append(
+                action['properties']['i']))
+
+        for i in range(50):
+            event = 'Poison' if i in (3, 40) else 'Played a Song'
+            client.track('ilya@analytics.io', event, {'i': i})
+        client.flush(async=False)
+
+        self.assertEqual(sorted(dead), [3, 40])
+        self.assertEqual(stats.successful, 48)
+        self.assertEqual(stats.failed, 2)
+
+    def test_every_rejected_action_is_a_dead_letter(self):
+
+        stats = Statistics()
+        store = MemoryDeadLetterStore()
+        client = queueing_client(stats=stats, transport=RejectingTransport(),
+                                 dead_letters=store, async=False)
+
+        for i in range(3):
+            client.track('ilya@analytics.io', 'Poison')
+        client.flush(async=False)
+
+        self.assertEqual(stats.dead_letters, 3)
+        self.assertEqual(stats.failed, 3)
+        self.assertEqual(len(store), 3)
+
+    def test_bisection_is_capped(self):
+
+        stats = Statistics()
+        transport = RejectingTransport()
+        client = queueing_client(stats=stats, transport=transport,
+                                 async=False, max_bisections=6)
+
+        for i in range(8):
+            client.track('ilya@analytics.io', 'Poison')
+        client.flush(async=False)
+
+        # 8 -> 4 + 4 -> 2 + 2 + 2 + 2, then the pairs fail
+        self.assertEqual(transport.batches, 7)
+        self.assertEqual(stats.bisections, 6)
+        self.assertEqual(stats.failed, 8)
+        self.assertEqual(stats.dead_letters, 0)
+
+    def test_bisection_disabled(self):
+
+        stats = Statistics()
+        client = queueing_client(stats=stats, transport=RejectingTransport(),
+                                 async=False, bisect_rejections=False)
+
+        client.track('ilya@analytics.io', 'Played a Song')
+        client.track('ilya@analytics.io', 'Poison')
+        client.flush(async=False)
+
+        self.assertEqual(stats.bisections, 0)
+        self.assertEqual(stats.dead_letters, 0)
+        self.assertEqual(stats.failed, 2)
+
+
+class AnalyticsDeadLetterTests(unittest.TestCase):
+
+    def test_failures_are_stored(self):
+
+        transport = FlakyTransport()
+        transport.failing = True
+        store = MemoryDeadLetterStore(max_size=3)
+        client = queueing_client(transport=transport, dead_letters=store,
+                                 async=False)
+
+        for i in range(5):
+            client.track('ilya@analytics.io', 'Played a Song', {'i': i})
+        client.flush(async=False)
+
+        # the ring keeps the latest
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.dropped, 2)
+
+        records = store.take(10)
+        self.assertEqual([r['action']['properties']['i'] for r in records],
+                         [2, 3, 4])
+        self.assertEqual(records[0]['attempts'], 1)
+        self.assertEqual(records[0]['error'], 'Flaky')
+
+    def test_file_store(self):
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        store = FileDeadLetterStore(directory, segment_bytes=1,
+                                    max_segments=3)
+        for i in range(5):
+            store.add({'action': 'track', 'i': i}, Exception('Down'))
+        store.close()
+
+        # one record per segment, the oldest two were deleted
+        self.assertEqual(store.dropped, 2)
+
+        store = FileDeadLetterStore(directory)
+        self.assertEqual(len(store), 3)
+        self.assertEqual([r['action']['i'] for r in store.take(2)], [2, 3])
+        store.add({'action': 'track', 'i': 5}, Exception('Down'), 2)
+        self.assertEqual([(r['action']['i'], r['attempts'])
+                          for r in store.take(10)], [(4, 1), (5, 2)])
+        self.assertEqual(len(store), 0)
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_replay(self):
+
+        store = MemoryDeadLetterStore()
+        for i in range(25):
+            store.add({'action': 'track', 'i': i}, Exception('Down'))
+
+        transport = FlakyTransport()
+        transport.failing = True
+        replayer = Replayer(store, secret, transport=transport,
+                            batch_size=10, rate=None)
+
+        # the upstream is still down, the batch goes back as it was
+        self.assertEqual(replayer.run(), 0)
+        self.assertEqual(len(store), 25)
+        records = store.take(25)
+        self.assertEqual([r['action']['i'] for r in records],
+                         range(10, 25) + range(10))
+        self.assertEqual(set(r['attempts'] for r in records), set([1]))
+
+        for i in range(25):
+            store.add({'action': 'track', 'i': i}, Exception('Down'))
+        transport.failing = False
+        self.assertEqual(replayer.run(), 25)
+        self.assertEqual(transport.batches, 3)
+        self.assertEqual(len(store), 0)
+
+    def test_outages_use_no_attempts(self):
+
+        store = MemoryDeadLetterStore()
+        for i in range(5):
+            store.add({'action': 'track', 'i': i}, Exception('Down'))
+
+        transport = FlakyTransport()
+        transport.failing = True
+        replayer = Replayer(store, secret, transport=transport,
+                            rate=None, max_attempts=3)
+
+        for i in range(3):
+            self.assertEqual(replayer.run(), 0)
+
+        self.assertEqual(replayer.discarded, 0)
+        self.assertEqual(len(store), 5)
+
+    def test_replay_bisection_is_rate_limited(self):
+
+        store = MemoryDeadLetterStore()
+        for i in range(8):
+            event = 'Poison' if i == 5 else 'Played a Song'
+            store.add({'action': 'track', 'event': event}, Exception('Down'))
+
+        transport = RejectingTransport()
+        replayer = Replayer(store, secret, transport=transport,
+                            batch_size=8, rate=20)
+
+        start = time()
+        self.assertEqual(replayer.run(), 7)
+        # 7 requests at 20 a second bisecting the batch, then the rejected
+        # action alone fails again and stops the replay
+        self.assertEqual(replayer.requests, 8)
+        self.assertTrue(time() - start >= 0.3)
+        self.assertEqual(store.take(1)[0]['attempts'], 3)
+
+    def test_gzip(self):
+
+        import gzip
+        from StringIO import StringIO
+
+        body = json.dumps({'batch': [{'action': 'track'}] * 100})
+        compressed = gzip_compress(body)
+        self.assertTrue(len(compressed) < len(body) / 10)
+        self.assertEqual(
+            gzip.GzipFile(fileobj=StringIO(compressed)).read(), body)
+
+
+class AnalyticsDeferredCleaningTests(unittest.TestCase):
+
+    def test_cleaned_when_flushed(self):
+
+        transport = MemoryTransport()
+        client = queueing_client(transport=transport, defer_cleaning=True,
+                                 async=False)
+
+        properties = {'When': datetime(2013, 1, 1, tzinfo=tzutc()),
+                      'Tags': set(['rock']),
+                      'Nested': {'Plays': Decimal('1.5')}}
+        client.track('ilya@analytics.io', 'Played a Song', properties)
+
+        # the top level is copied, mutating it afterwards is safe
+        properties['Song'] = 'Yesterday'
+
+        queued = list(client.queue)[0]
+        self.assertTrue(isinstance(queued['timestamp'], datetime))
+        self.assertTrue(isinstance(queued['properties']['When'], datetime))
+
+        client.flush(async=False)
+
+        action = transport.actions[0]
+        self.assertEqual(action['properties'], {
+            'When': '2013-01-01T00:00:00+00:00',
+            'Tags': ['rock'],
+            'Nested': {'Plays': 1.5}})
+        self.assertTrue(isinstance(action['timestamp'], basestring))
+
+    def test_duplicate_identifies_dropped_when_flushed(self):
+
+        stats = Statistics()
+        transport = MemoryTransport()
+        client = queueing_client(stats=stats, transport=transport,
+                                 defer_cleaning=True, async=False,
+                                 identify_dedup_window=timedelta(hours=1))
+
+        for i in range(3):
+            client.identify('ilya@analytics.io', {'Plan': 'pro'})
+        client.flush(async=False)
+
+        self.assertEqual(stats.identifies_suppressed, 2)
+        self.assertEqual(len(transport.actions), 1)
+
+        # counted when queued, before they were found to be duplicates
+        self.assertEqual(stats.identifies, 3)
+        self.assertEqual(stats.submitted, 3)
+        self.assertEqual(stats.successful, 1)
+
+
+class AnalyticsCoalescingTests(unittest.TestCase):
+
+    def test_identifies_merged_per_user(self):
+
+        stats = Statistics()
+        transport = MemoryTransport()
+        client = queueing_client(stats=stats, transport=transport,
+                                 coalesce_identifies=True, async=False)
+
+        early = datetime(2013, 1, 1, tzinfo=tzutc())
+        late = datetime(2013, 1, 2, tzinfo=tzutc())
+
+        client.identify('ilya@analytics.io', {'Plan': 'free', 'Age': 25},
+                        timestamp=early)
+        client.identify('peter@analytics.io', {'Plan': 'pro'})
+        client.identify('ilya@analytics.io', {'Plan': 'pro'},
+                        timestamp=late)
+        # older than what's queued, only fills in missing traits
+        client.identify('ilya@analytics.io',
+                        {'Plan': 'trial', 'Name': 'Ilya'}, timestamp=early)
+
+        self.assertEqual(len(client.queue), 2)
+        self.assertEqual(stats.identifies, 2)
+        self.assertEqual(stats.identifies_coalesced, 2)
+
+        client.flush(async=False)
+
+        action = transport.actions[0]
+        self.assertEqual(action['userId'], 'ilya@analytics.io')
+        self.assertEqual(action['traits'],
+                         {'Plan': 'pro', 'Age': 25, 'Name': 'Ilya'})
+        self.assertEqual(action['timestamp'], late.isoformat())
+
+        # once sent, the next identify is queued anew
+        client.identify('ilya@analytics.io', {'Plan': 'free'})
+        self.assertEqual(len(client.queue), 1)
+        self.assertEqual(stats.identifies, 3)
+
+    def test_identifies_not_merged_across_lanes(self):
+
+        stats = Statistics()
+        client = queueing_client(stats=stats, coalesce_identifies=True,
+                                 lanes={'critical': {'weight': 4}})
+
+        client.identify('ilya@analytics.io', {'Plan': 'free'})
+        client.identify('ilya@analytics.io', {'Plan': 'pro'},
+                        lane='critical')
+
+        self.assertEqual(len(client.queue), 2)
+        self.assertEqual(len(client.queue.lane('critical').actions), 1)
+        self.assertEqual(stats.identifies_coalesced, 0)
+
+    def test_coalescing_with_deduplication(self):
+
+        stats = Statistics()
+        transport = MemoryTransport()
+        client = queueing_client(stats=stats, transport=transport,
+                                 coalesce_identifies=True, async=False,
+                                 identify_dedup_window=timedelta(hours=1))
+
+        client.identify('ilya@analytics.io', {'Plan': 'pro'})
+        client.identify('ilya@analytics.io', {'Plan': 'free'})
+        # the queued identify says free now, this is no duplicate
+        client.identify('ilya@analytics.io', {'Plan': 'pro'})
+        # but this one is
+        client.identify('ilya@analytics.io', {'Plan': 'pro'})
+
+        self.assertEqual(stats.identifies_coalesced, 2)
+        self.assertEqual(stats.identifies_suppressed, 1)
+
+        client.flush(async=False)
+
+        self.assertEqual([a['traits'] for a in transport.actions],
+                         [{'Plan': 'pro'}])
+
+    def test_flush_outside_the_index_lock(self):
+
+        locked = []
+
+        def probe(client):
+            if client.pending_lock.acquire(False):
+                client.pending_lock.release()
+                locked.append(False)
+            else:
+                locked.append(True)
+
+        class LockCheckingTransport(MemoryTransport):
+            def send(self, client, data):
+                # another thread can only take the lock if it isn't held
+                thread = threading.Thread(target=probe, args=(client,))
+                thread.start()
+                thread.join()
+                return MemoryTransport.send(self, client, data)
+
+        client = queueing_client(transport=LockCheckingTransport(),
+                                 coalesce_identifies=True, async=False)
+        client.flush_at = 1
+        client.identify('ilya@analytics.io', {'Plan': 'pro'})
+
+        self.assertEqual(locked, [False])
+
+
+class AnalyticsQueueBytesTests(unittest.TestCase):
+
+    def test_byte_ceiling(self):
+
+        stats = Statistics()
+        client = queueing_client(stats=stats, transport=MemoryTransport(),
+                                 max_queue_bytes=2000, async=False)
+
+        client.track('ilya@analytics.io', 'Played a Song', {'Plays': 1})
+        small = stats.queue_bytes
+        self.assertTrue(100 < small < 400)
+
+        client.identify('ilya@analytics.io', {'Bio': 'x' * 5000})
+        self.assertEqual(stats.dropped, 1)
+        self.assertEqual(stats.queue_bytes, small)
+
+        while stats.dropped == 1:
+            client.track('ilya@analytics.io', 'Played a Song', {'Plays': 1})
+        self.assertTrue(stats.queue_bytes <= 2000)
+        self.assertTrue(stats.queue_bytes > 2000 - small)
+
+        client.flush(async=False)
+        self.assertEqual(stats.queue_bytes, 0)
+        self.assertEqual(client.queue.sizes, {})
+
+    def test_unknown_values_deferred(self):
+
+        class Cafe(object):
+            def __str__(self):
+                return u'caf\xe9'
+
+        client = queueing_client(max_queue_bytes=2000, defer_cleaning=True)
+        client.track('ilya@analytics.io', 'Played a Song', {'x': Cafe()})
+        self.assertEqual(len(client.queue), 1)
+
+    def test_eviction_makes_room(self):
+
+        stats = Statistics()
+        client = queueing_client(
+            stats=stats, max_queue_bytes=10000,
+            lanes={'default': {'capacity': 3, 'overflow': 'drop_oldest'}})
+
+        client.track('ilya@analytics.io', 'Played a Song', {'Bio': 'x' * 200})
+        # room for exactly the lane's capacity
+        client.queue.max_bytes = 3 * stats.queue_bytes
+
+        for i in range(3):
+            client.track('ilya@analytics.io', 'Played a Song',
+                         {'Bio': 'x' * 200})
+
+        # the oldest was evicted to make room for the fourth
+        self.assertEqual(len(client.queue), 3)
+        self.assertEqual(stats.dropped, 1)
+        self.assertEqual(stats.queue_bytes, client.queue.max_bytes)
+
+    def test_coalescing_respects_ceiling(self):
+
+        stats = Statistics()
+        client = queueing_client(stats=stats, max_queue_bytes=1000,
+                                 coalesce_identifies=True)
+
+        client.identify('ilya@analytics.io', {'Plan': 'pro'})
+        client.identify('ilya@analytics.io', {'Bio': 'x' * 2000})
+
+        self.assertEqual(stats.dropped, 1)
+        self.assertEqual(stats.identifies_coalesced, 0)
+        self.assertTrue('Bio' not in list(client.queue)[0]['traits'])
+        self.assertTrue(stats.queue_bytes <= 1000)
+
+
+class AnalyticsContextHoistingTests(unittest.TestCase):
+
+    def test_hoist_context(self):
+
+        shared = {'library': 'analytics-python', 'userAgent': 'Safari'}
+        batch = [
+            {'action': 'track', 'context': shared},
+            {'action': 'track', 'context': shared},
+            {'action': 'track', 'context': dict(shared, ip='10.0.0.1')},
+            {'action': 'track', 'context': dict(shared, userAgent='Chrome')}
+        ]
+        payload = {'secret': secret, 'batch': batch}
+        original = json.loads(json.dumps(payload))
+
+        hoisted = json.loads(json.dumps(hoist_context(payload)))
+        self.assertEqual(hoisted['context'], {'library': 'analytics-python'})
+        self.assertEqual(hoisted['batch'][3]['context'],
+                         {'userAgent': 'Chrome'})
+        self.assertEqual(merge_context(hoisted), original['batch'])
+
+        # the queued actions are left alone
+        self.assertTrue(batch[0]['context'] is shared)
+
+        # the serializer encodes the same, putting the contexts back after
+        serializer = ContextHoistingSerializer(JSONSerializer())
+        self.assertEqual(json.loads(serializer.dumps(payload)), hoisted)
+        self.assertEqual(json.loads(json.dumps(payload)), original)
+        self.assertTrue(batch[0]['context'] is shared)
+
+        # nothing in common, nothing hoisted
+        payload = {'batch': [{'context': {'ip': '1'}},
+                             {'context': {'ip': '2'}}]}
+        self.assertTrue(hoist_context(payload) is payload)
+
+    def test_client_hoists(self):
+
+        client = queueing_client(hoist_context=True)
+        client.track('ilya@analytics.io', 'Played a Song')
+        client.track('peter@analytics.io', 'Played a Song')
+
+        encoded = json.loads(client.serializer.dumps(
+            {'batch': list(client.queue), 'secret': secret}))
+        self.assertEqual(encoded['context'], {'library': 'analytics-python'})
+        self.assertTrue('context' not in encoded['batch'][0])
+
+
 if __name__ == '__main__':
     unittest.main()